@@ -25,20 +25,22 @@
 
 from __future__ import unicode_literals, print_function
 
+import os
 import sys
+import socket
 from contextlib import closing
 from getopt import getopt, GetoptError
 
-try:
-    import readline
-except ImportError:
-    pass
-
 from convoread.convore import Convore
+from convoread.asyncconvore import AsyncConvore
 from convoread.config import config
 from convoread.console import Console
+from convoread.daemon import Daemon, RemoteConvore
+from convoread.metrics import start_dump
 from convoread.notify import Notifier
-from convoread.utils import error
+from convoread.stream import Streamer
+from convoread.utils import (error, flush_output, setup_logging,
+                             startup_trace)
 
 __version__ = b'0.5'
 
@@ -62,6 +64,23 @@ options:
   -h --help     show help
   --debug       show debug messages
   --no-notify   disable desktop notifications
+  --workers=N   number of parallel requests for fetching topics
+  --event-loop  run all network requests on a single event loop thread
+  --daemon      serve one connection to convore.com to local clients
+  --attach      connect to a running daemon instead of convore.com
+  --metrics-file=PATH
+                write request, live stream and lock metrics to <path> as
+                JSON every METRICS_DUMP_INTERVAL seconds
+  --startup-trace
+                show how long each phase of startup takes
+
+streaming:
+
+  --stream            write live events to stdout as JSON lines
+  --group=NAME        stream only events of group <name>
+  --topic=NUM         stream only events of topic <num>
+  --cursor-file=PATH  save the position in the stream to <path> and resume
+                      from it
 '''.format(version=__version__)
     print(msg.encode(ENCODING), file=sys.stderr)
 
@@ -70,13 +89,21 @@ def main():
     try:
         opts, args = getopt(sys.argv[1:],
                             b'h',
-                            [b'help', b'debug', b'no-notify'])
+                            [b'help', b'debug', b'no-notify', b'workers=',
+                             b'event-loop', b'daemon', b'attach', b'stream',
+                             b'group=', b'topic=', b'cursor-file=',
+                             b'metrics-file=', b'startup-trace'])
     except GetoptError, e:
         error(bytes(e).decode(ENCODING, errors='replace'))
         usage()
         sys.exit(1)
 
     notify = True
+    metrics_file = None
+    daemon = False
+    attach = False
+    stream = False
+    stream_options = {}
     for opt, arg in opts:
         if opt in [b'-h', b'--help']:
             usage()
@@ -85,15 +112,96 @@ def main():
             config['DEBUG'] = True
         elif opt == b'--no-notify':
             notify = False
-
-    with closing(Convore()) as convore:
+        elif opt == b'--event-loop':
+            config['EVENT_LOOP'] = True
+        elif opt == b'--daemon':
+            daemon = True
+        elif opt == b'--attach':
+            attach = True
+        elif opt == b'--stream':
+            stream = True
+        elif opt == b'--group':
+            stream_options['group'] = arg.decode(ENCODING, 'replace')
+        elif opt == b'--topic':
+            try:
+                stream_options['topic'] = int(arg)
+            except ValueError:
+                error('bad topic "{0}"'.format(
+                          arg.decode(ENCODING, 'replace')))
+                usage()
+                sys.exit(1)
+        elif opt == b'--cursor-file':
+            stream_options['cursor_file'] = os.path.expanduser(arg)
+        elif opt == b'--metrics-file':
+            metrics_file = os.path.expanduser(arg)
+        elif opt == b'--startup-trace':
+            startup_trace.enabled = True
+        elif opt == b'--workers':
+            try:
+                config['FETCH_WORKERS'] = max(int(arg), 1)
+            except ValueError:
+                error('bad number of workers: {0}'.format(
+                          arg.decode(ENCODING, 'replace')))
+                usage()
+                sys.exit(1)
+    setup_logging()
+    if metrics_file:
+        start_dump(metrics_file, config['METRICS_DUMP_INTERVAL'])
+    startup_trace.mark('imports and options')
+
+    client = AsyncConvore if config['EVENT_LOOP'] else Convore
+    if stream:
+        with closing(client()) as convore:
+            streamer = Streamer(convore, **stream_options)
+            try:
+                streamer.run()
+            except KeyboardInterrupt:
+                pass
+            except ValueError, e:
+                error(unicode(e))
+                sys.exit(1)
+            finally:
+                streamer.close()
+        return
+
+    if daemon:
+        with closing(client()) as convore:
+            try:
+                server = Daemon(convore)
+            except (RuntimeError, socket.error), e:
+                error(unicode(e))
+                sys.exit(1)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.close()
+        return
+
+    if attach:
+        try:
+            convore = RemoteConvore()
+        except socket.error, e:
+            error('cannot connect to the daemon: {0}'.format(e.args[-1]))
+            sys.exit(1)
+    else:
+        convore = client()
+    startup_trace.mark('client')
+
+    with closing(convore):
         console = Console(convore)
         if notify:
             notifier = Notifier(convore)
+        startup_trace.mark('console and notifier')
         try:
             console.loop()
         except (EOFError, KeyboardInterrupt):
             print('quit', file=sys.stderr)
+        finally:
+            if notify:
+                notifier.close()
+            flush_output()
 
 
 if __name__ == '__main__':
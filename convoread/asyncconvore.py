@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''Convore client that runs all network I/O on a single event loop thread.'''
+
+from __future__ import unicode_literals, print_function
+
+import socket
+from threading import Thread
+from urllib import urlencode
+from Queue import Queue
+
+from convoread.convore import (Convore, NetworkError, ReconnectScheduler,
+                               authheader, counted, deliver,
+                               decode_response, decompress, group_topics_url,
+                               is_cacheable, live_log, log_failure,
+                               measure_request, parse_group_topics,
+                               response_cache, socket_error)
+from convoread.eventloop import (EventLoop, Future, Return, fetch, gather,
+                                 sleep)
+from convoread.metrics import metrics
+from convoread.utils import Logger, get_passwd, base_url
+
+
+log = Logger('connection')
+
+
+class AsyncConvore(Convore):
+    '''Convore client with the event loop core.
+
+    Long polling, topic refreshes and requests made by commands run
+    concurrently on the event loop thread. Blocking methods are the same as
+    in `Convore` and may be called from any other thread.
+    '''
+    def __init__(self):
+        self._loop = EventLoop()
+        thread = Thread(target=self._loop.run_forever, name='eventloop')
+        thread.daemon = True
+        thread.start()
+        self._connection = AsyncConnection(self._loop)
+        Convore.__init__(self)
+
+
+    def close(self):
+        Convore.close(self)
+        self._loop.stop()
+
+
+    def _create_connection(self):
+        # Requests on the event loop don't share sockets, so blocking callers
+        # may use the same connection concurrently
+        return self._connection
+
+
+    def _create_live(self):
+        return AsyncLive(self._loop, self._connection)
+
+
+    def _fetch_topics(self, group_ids):
+        connection = self._connection
+
+        def fetch_all():
+            futures = yield gather(self._loop, [
+                    connection.request_async('GET', group_topics_url(id))
+                    for id in group_ids])
+            raise Return(futures)
+
+        futures = self._loop.run_coroutine_threadsafe(fetch_all()).wait()
+        results = {}
+        errors = {}
+        for group_id, future in zip(group_ids, futures):
+            try:
+                results[group_id] = parse_group_topics(
+                        group_id, future.result().get('topics', []))
+            except NetworkError, e:
+                errors[group_id] = e
+        return results, errors
+
+
+class AsyncConnection(object):
+    '''Connection that makes requests on an event loop.
+
+    Each request uses a new socket, so any number of requests may run
+    concurrently. There is nothing to keep alive in a connection pool.
+    '''
+    def __init__(self, loop):
+        login, password = get_passwd()
+        self.username = login
+        self.secure, self.host, self.port = base_url()
+        self._loop = loop
+        self._headers = {
+            'Authorization': authheader(login, password),
+            'Accept-Encoding': 'gzip, deflate',
+        }
+
+
+    def request(self, method, url, params=None):
+        if self._loop.is_loop_thread():
+            raise RuntimeError('blocking request on the event loop thread')
+        coroutine = self.request_async(method, url, params)
+        return self._loop.run_coroutine_threadsafe(coroutine).wait()
+
+
+    def request_items(self, method, url, key, params=None):
+        '''Yield the items of the array `key` in the response in one list.
+
+        The event loop reads whole responses, so there is no point in
+        decoding them incrementally.
+        '''
+        items = self.request(method, url, params).get(key, [])
+        if items:
+            yield items
+
+
+    def request_async(self, method, url, params=None):
+        with measure_request(method, url):
+            result = yield self._loop.create_task(
+                    self._request_async(method, url, params))
+        raise Return(result)
+
+
+    def _request_async(self, method, url, params=None):
+        body = None
+        cacheable = method == 'GET' and is_cacheable(url)
+        if params:
+            if method == 'GET':
+                url = '{path}?{params}'.format(path=url,
+                                               params=urlencode(params))
+            else:
+                body = urlencode(params)
+        log.debug('{0} {1} HTTP/1.1', method, url)
+        headers = dict(self._headers)
+        if cacheable:
+            headers.update(response_cache.validators(url))
+        if body:
+            metrics.increment('http.bytes_out', len(body))
+        try:
+            status, reason, headers, data = yield self._loop.create_task(
+                    fetch(self._loop, self.host, method, url, body, headers,
+                          self.port, self.secure))
+        except socket.error, e:
+            raise socket_error(e, self.host)
+        except ValueError, e:
+            raise NetworkError('bad server response: {0}'.format(e))
+        log.debug('HTTP/1.1 {0} {1}', status, reason, url=url)
+        if status == 304 and cacheable:
+            data = response_cache.get(url)
+            status = 200 if data is not None else status
+        elif status // 100 == 2:
+            data = decompress(counted([data]),
+                              headers.get('content-encoding'))
+            if cacheable:
+                response_cache.put(url, headers.get('etag'),
+                                   headers.get('last-modified'), data)
+        raise Return(decode_response(status, reason, data))
+
+
+    def connect(self):
+        pass
+
+
+    def is_alive(self):
+        return True
+
+
+    def close(self):
+        pass
+
+
+class AsyncLive(object):
+    '''Live stream polled by a coroutine.
+
+    Callbacks are called on a separate thread, so they may use the blocking
+    `Convore` methods.
+    '''
+    def __init__(self, loop, connection):
+        self._loop = loop
+        self._connection = connection
+        self._cursor = None
+        self._callbacks = []
+        self._closed = False
+        self._ready = Future()
+        self._reconnect = ReconnectScheduler()
+        self._queue = Queue()
+        thread = Thread(target=self._dispatch, name='live')
+        thread.daemon = True
+        thread.start()
+        loop.call_soon_threadsafe(self._start)
+
+
+    def on_update(self, callback, batch=False, raw=False):
+        self._callbacks.append((callback, batch, raw))
+
+
+    def set_cursor(self, cursor):
+        self._cursor = cursor
+
+
+    def set_ready(self):
+        def ready():
+            if not self._ready.done():
+                self._ready.set_result(None)
+        self._loop.call_soon_threadsafe(ready)
+
+
+    def stats(self):
+        return self._reconnect.stats()
+
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+
+
+    def _start(self):
+        task = self._loop.create_task(self._poll())
+        task.add_done_callback(self._poll_done)
+
+
+    def _poll_done(self, task):
+        try:
+            task.result()
+        except Exception, e:
+            live_log.error('live stream stopped: {0}', e, exc=e)
+
+
+    def _poll(self):
+        yield self._ready
+
+        url = '/api/live.json'
+        params = {}
+        if self._cursor:
+            params['cursor'] = self._cursor
+
+        while not self._closed:
+            try:
+                event = yield self._loop.create_task(
+                        self._connection.request_async('GET', url, params))
+                if not isinstance(event, dict):
+                    raise NetworkError('bad server response: {0}'.format(
+                            event))
+            except NetworkError, e:
+                if self._closed:
+                    return
+                delay = self._reconnect.failure(e)
+                log_failure(e, delay)
+                yield sleep(self._loop, delay)
+                continue
+            self._reconnect.success()
+
+            messages = event.get('messages', [])
+            if messages:
+                params['cursor'] = messages[-1].get('_id', 'null')
+                self._queue.put(messages)
+
+
+    def _dispatch(self):
+        while True:
+            messages = self._queue.get()
+            if messages is None:
+                return
+            deliver(self._callbacks, messages)
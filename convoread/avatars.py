@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import json
+import time
+import urllib2
+from hashlib import sha1
+from contextlib import closing
+from tempfile import NamedTemporaryFile
+from threading import Thread, Lock
+from Queue import Queue, Empty
+
+from convoread.config import config
+from convoread.utils import Logger, atomic_write, cache_dir, makedirs
+
+
+log = Logger('notify')
+
+
+class AvatarCache(object):
+    '''Persistent cache of avatar thumbnails shared across sessions.
+
+    Files are named by the sha1 of the image URL. An index keeps the HTTP
+    validators and the last use time of each file. Entries older than
+    AVATAR_MAX_AGE are revalidated, the least recently used ones are evicted
+    when the total size exceeds AVATAR_CACHE_SIZE.
+    '''
+    def __init__(self, thumbnail, path=None):
+        if path is None:
+            path = os.path.join(cache_dir(), 'avatars')
+        self.path = makedirs(path)
+        self._thumbnail = thumbnail
+        self._index_path = os.path.join(self.path, 'index.json')
+        self._index = self._load_index()
+        self._dirty = False
+        self._lock = Lock()
+
+
+    def get(self, url):
+        '''Return the path to the thumbnail of `url`, fetch it if needed.'''
+        key = sha1(url.encode('UTF-8')).hexdigest()
+        path = os.path.join(self.path, key + '.jpg')
+        with self._lock:
+            entry = self._index.get(key)
+            if entry and not os.path.exists(path):
+                del self._index[key]
+                entry = None
+            if entry:
+                entry['used'] = time.time()
+                self._dirty = True
+                age = time.time() - entry['checked']
+                if age < config['AVATAR_MAX_AGE']:
+                    return path
+        try:
+            self._fetch(url, key, path, entry)
+        except (IOError, urllib2.URLError), e:
+            log.debug('cannot get avatar {0}: {1}', url, e)
+        return path if os.path.exists(path) else None
+
+
+    def prefetch(self, urls):
+        '''Fetch the missing or stale avatars in background threads.'''
+        queue = Queue()
+        for url in set(urls):
+            queue.put(url)
+
+        def worker():
+            while True:
+                try:
+                    self.get(queue.get_nowait())
+                except Empty:
+                    return
+
+        n = min(config['AVATAR_PREFETCH_WORKERS'], queue.qsize())
+        for _ in range(n):
+            thread = Thread(target=worker, name='avatars')
+            thread.daemon = True
+            thread.start()
+
+
+    def close(self):
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+
+    def _fetch(self, url, key, path, entry):
+        request = urllib2.Request(url)
+        if entry and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if entry and entry.get('last_modified'):
+            request.add_header('If-Modified-Since', entry['last_modified'])
+        log.debug('GET {0} HTTP/1.1', url)
+        try:
+            src = urllib2.urlopen(request, timeout=30)
+        except urllib2.HTTPError, e:
+            if e.code != 304:
+                raise
+            log.debug('HTTP/1.1 304 Not Modified', url=url)
+            with self._lock:
+                entry['checked'] = time.time()
+                self._save_index()
+            return
+
+        with closing(src):
+            headers = src.info()
+            tmp = NamedTemporaryFile(dir=self.path, prefix='.tmp',
+                                     suffix='.jpg', delete=False)
+            try:
+                with closing(tmp):
+                    for block in iter(lambda: src.read(4096), b''):
+                        tmp.write(block)
+                self._thumbnail(tmp.name)
+                os.rename(tmp.name, path)
+            except:
+                os.remove(tmp.name)
+                raise
+
+        now = time.time()
+        with self._lock:
+            self._index[key] = {
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'size': os.path.getsize(path),
+                'used': now,
+                'checked': now,
+            }
+            self._evict()
+            self._save_index()
+
+
+    def _evict(self):
+        total = sum(e['size'] for e in self._index.values())
+        lru = sorted(self._index, key=lambda k: self._index[k]['used'])
+        for key in lru:
+            if total <= config['AVATAR_CACHE_SIZE']:
+                break
+            total -= self._index.pop(key)['size']
+            try:
+                os.remove(os.path.join(self.path, key + '.jpg'))
+            except OSError:
+                pass
+
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, 'rb') as fd:
+                return json.loads(fd.read().decode('UTF-8'))
+        except (IOError, ValueError):
+            return {}
+
+
+    def _save_index(self):
+        try:
+            atomic_write(self._index_path,
+                         json.dumps(self._index).encode('UTF-8'))
+            self._dirty = False
+        except (IOError, OSError), e:
+            log.debug('cannot save avatar index: {0}', e)
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''Benchmarks of convoread against a local fake Convore server.
+
+Usage: python -m convoread.bench [OPTIONS]
+
+Results are printed as JSON and can be compared with the results of another
+run using --compare.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import tempfile
+from getopt import getopt, GetoptError
+
+from convoread.config import config
+
+
+USAGE = '''usage: python -m convoread.bench [OPTIONS]
+
+options:
+
+  -h --help           show help
+  --groups=N          number of groups (default: 20)
+  --topics=N          number of topics per group (default: 10)
+  --message-size=N    length of message texts (default: 100)
+  --latency=MS        server latency in milliseconds (default: 50)
+  --live=N            number of live messages for throughput (default: 5000)
+  --rate=N            live messages per second sent by the server (default: 0)
+  --output=FILE       write results to FILE instead of stdout
+  --compare=FILE      compare results with a previous run
+'''
+
+
+def main():
+    try:
+        opts, args = getopt(sys.argv[1:], b'h',
+                            [b'help', b'groups=', b'topics=',
+                             b'message-size=', b'latency=', b'live=',
+                             b'rate=', b'output=', b'compare='])
+    except GetoptError, e:
+        print(e, file=sys.stderr)
+        print(USAGE, file=sys.stderr)
+        sys.exit(1)
+
+    params = {
+        'groups': 20,
+        'topics': 10,
+        'message_size': 100,
+        'latency': 50,
+        'live': 5000,
+        'rate': 0,
+    }
+    output_file = compare_file = None
+    for opt, arg in opts:
+        name = opt.lstrip(b'-').replace(b'-', b'_').decode('ascii')
+        if opt in [b'-h', b'--help']:
+            print(USAGE)
+            sys.exit(0)
+        elif opt == b'--output':
+            output_file = arg
+        elif opt == b'--compare':
+            compare_file = arg
+        else:
+            try:
+                params[name] = int(arg)
+            except ValueError:
+                print('bad value for {0}: {1}'.format(opt, arg),
+                      file=sys.stderr)
+                sys.exit(1)
+
+    results = run(**params)
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if output_file:
+        with open(output_file, 'wb') as fd:
+            fd.write(data.encode('UTF-8'))
+    else:
+        print(data)
+    if compare_file:
+        with open(compare_file, 'rb') as fd:
+            previous = json.loads(fd.read().decode('UTF-8'))
+        print(compare(previous, results), file=sys.stderr)
+
+
+def run(groups, topics, message_size, latency, live, rate):
+    '''Run all benchmarks, return a dict of parameters and results.'''
+    from convoread.fakeserver import FakeConvore
+
+    server = FakeConvore(groups=groups, topics=topics,
+                         message_size=message_size,
+                         latency=latency / 1000.0, rate=rate)
+    server.start()
+    tmpdir = tempfile.mkdtemp(prefix='convoread-bench')
+    netrc = os.path.join(tmpdir, 'netrc')
+    with open(netrc, 'wb') as fd:
+        fd.write(b'machine 127.0.0.1 login bench password bench\n')
+    os.environ['XDG_DATA_HOME'] = os.path.join(tmpdir, 'data')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(tmpdir, 'cache')
+    config['BASE_URL'] = server.url
+    config['NETRC'] = netrc
+    config['NOTIFY_SEND'] = '/bin/true'
+
+    results = {}
+    try:
+        with _quiet_stdout():
+            _bench_client(server, results, live)
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+    params = {
+        'groups': groups,
+        'topics': topics,
+        'message_size': message_size,
+        'latency': latency,
+        'live': live,
+        'rate': rate,
+    }
+    return {
+        'python': platform.python_version(),
+        'params': params,
+        'results': results,
+        'requests': server.requests,
+    }
+
+
+def _bench_client(server, results, live):
+    from convoread.convore import Convore
+    from convoread.models import Message
+    from convoread.console import Console
+    from convoread.notify import Notifier
+
+    rss_start = _rss()
+    t = time.time()
+    convore = Convore()
+    console = Console(convore)
+    notifier = Notifier(convore)
+    results['startup'] = time.time() - t
+    try:
+        t = time.time()
+        console.cmd_ts()
+        results['cold_ts'] = time.time() - t
+
+        t = time.time()
+        console.cmd_ts()
+        results['warm_ts'] = time.time() - t
+
+        topic_ids = sorted(server.topics)[:10]
+        t = time.time()
+        for topic_id in topic_ids:
+            console.cmd_t(str(topic_id))
+        results['t_first'] = (time.time() - t) / len(topic_ids)
+
+        t = time.time()
+        for topic_id in topic_ids:
+            console.cmd_t(str(topic_id))
+        results['t_repeat'] = (time.time() - t) / len(topic_ids)
+
+        messages = [Message.from_json(
+                        server.live_message(topic_ids[i % len(topic_ids)],
+                                            'user{0}'.format(i % 7)))
+                    for i in range(live)]
+        handlers = [convore._handle_live_update,
+                    console.handle_live_update,
+                    notifier.handle_live_update]
+        rss_before_live = _rss()
+        t = time.time()
+        for message in messages:
+            for handler in handlers:
+                handler(message)
+        elapsed = time.time() - t
+        results['live_per_sec'] = live / elapsed if elapsed else None
+
+        batch_handlers = [convore._handle_live_batch,
+                          console.handle_live_batch,
+                          notifier.handle_live_batch]
+        t = time.time()
+        for i in range(0, len(messages), 100):
+            for handler in batch_handlers:
+                handler(messages[i:i + 100])
+        elapsed = time.time() - t
+        results['live_batch_per_sec'] = live / elapsed if elapsed else None
+        gc.collect()
+        results['rss_live_growth_kb'] = _rss() - rss_before_live
+
+        template = server.live_message(topic_ids[0], 'user0')
+        rss_before_cached = _rss()
+        cached = [Message.from_json(dict(template, id=i, _id=str(i),
+                                         message='message {0}'.format(i)))
+                  for i in range(100000)]
+        results['rss_100k_messages_kb'] = _rss() - rss_before_cached
+        del cached
+        gc.collect()
+        results['rss_growth_kb'] = _rss() - rss_start
+    finally:
+        notifier.close()
+        convore.close()
+
+
+def compare(previous, current):
+    '''Return a table of relative changes between two runs.'''
+    lines = ['{0:24} {1:>12} {2:>12} {3:>8}'.format('metric', 'previous',
+                                                    'current', 'change')]
+    old = previous.get('results', {})
+    new = current.get('results', {})
+    for name in sorted(set(old) | set(new)):
+        a, b = old.get(name), new.get(name)
+        change = ''
+        if a and b is not None:
+            change = '{0:+.1%}'.format((b - a) / float(a))
+        lines.append('{0:24} {1:>12} {2:>12} {3:>8}'.format(
+                name, _fmt(a), _fmt(b), change))
+    return '\n'.join(lines)
+
+
+def _fmt(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{0:.4g}'.format(value)
+    return unicode(value)
+
+
+def _rss():
+    '''Return the resident set size of the process in KB.'''
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+        return pages * os.sysconf(b'SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _quiet_stdout(object):
+    '''Redirect the stdout file descriptor to /dev/null.'''
+    def __enter__(self):
+        sys.stdout.flush()
+        self._saved = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.close(devnull)
+
+
+    def __exit__(self, *exc_info):
+        os.dup2(self._saved, 1)
+        os.close(self._saved)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import json
+
+from convoread.models import Group, Message, Topic
+from convoread.utils import debug, data_dir, atomic_write
+
+
+CACHE_VERSION = 1
+
+
+class Cache(object):
+    '''Persistent cache of groups, topics and recent messages.
+
+    The cache is a single versioned JSON file under the user data dir. A
+    missing, corrupted or outdated file is treated as an empty cache.
+    '''
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(data_dir(), 'cache.json')
+        self.path = path
+
+
+    def load(self, username):
+        '''Return a tuple `(groups, topics, messages)` of the cached data.'''
+        empty = ({}, {}, {})
+        try:
+            with open(self.path, 'rb') as fd:
+                data = json.loads(fd.read().decode('UTF-8'))
+        except IOError:
+            return empty
+        except ValueError, e:
+            debug('ignoring corrupted cache "{0}": {1}', self.path, e)
+            return empty
+
+        if data.get('version') != CACHE_VERSION:
+            debug('ignoring cache of version {0}', data.get('version'))
+            return empty
+        if data.get('username') != username:
+            return empty
+
+        groups = dict((g.get('id'), Group.from_json(g))
+                      for g in data.get('groups', []))
+        topics = dict((t.get('id'), Topic.from_json(t))
+                      for t in data.get('topics', []))
+        messages = dict((id, [Message.from_json(m) for m in ms])
+                        for id, ms in data.get('messages', []))
+        return groups, topics, messages
+
+
+    def save(self, username, groups, topics, messages):
+        data = {
+            'version': CACHE_VERSION,
+            'username': username,
+            'groups': [g.to_json() for g in groups.values()],
+            'topics': [t.to_json() for t in topics.values()],
+            'messages': [(id, [m.to_json() for m in ms])
+                         for id, ms in messages.items()],
+        }
+        try:
+            atomic_write(self.path, json.dumps(data).encode('UTF-8'))
+        except (IOError, OSError), e:
+            debug('cannot save cache "{0}": {1}', self.path, e)
@@ -25,6 +25,33 @@ config = {
     'DEBUG': False,
     'ENCODING': 'UTF-8',
     'PROMPT': '> ',
+    'OUTPUT_FPS': 20,
+    'BASE_URL': 'https://convore.com',
+    'NETRC': '~/.netrc',
     'NOTIFY_SEND': '/usr/bin/notify-send',
+    'FETCH_WORKERS': 8,
+    'POOL_SIZE': 10,
+    'POOL_WARM': 2,
+    'POOL_PROBE_INTERVAL': 15.0,
+    'CACHE_MESSAGES': 50,
+    'CACHE_TOTAL_MESSAGES': 5000,
+    'CACHE_TOPICS': 200,
+    'UNREAD_CHECK_INTERVAL': 300.0,
+    'SEARCH_QUEUE_SIZE': 1000,
+    'SEARCH_CANDIDATES': 500,
+    'RESPONSE_CACHE_BYTES': 4 * 1024 * 1024,
+    'LIVE_BACKOFF_BASE': 0.5,
+    'LIVE_BACKOFF_MAX': 60.0,
+    'EVENT_LOOP': False,
+    'DAEMON_CLIENT_QUEUE_SIZE': 1000,
+    'STREAM_CURSOR_INTERVAL': 1.0,
+    'METRICS_DUMP_INTERVAL': 60.0,
+    'NOTIFY_QUEUE_SIZE': 100,
+    'NOTIFY_COALESCE_TIME': 1.0,
+    'NOTIFY_RATE_LIMIT': 5,
+    'NOTIFY_RATE_WINDOW': 10.0,
+    'AVATAR_CACHE_SIZE': 5 * 1024 * 1024,
+    'AVATAR_MAX_AGE': 24 * 60 * 60,
+    'AVATAR_PREFETCH_WORKERS': 4,
 }
 
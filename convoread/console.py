@@ -22,35 +22,52 @@
 
 from __future__ import unicode_literals, print_function
 
+import time
 from datetime import datetime
 
 from convoread.convore import NetworkError
 from convoread.config import config
-from convoread.utils import error, debug, output, wrap_string
+from convoread.models import Message, User
+from convoread.utils import (error, debug, output, wrap_string,
+                             init_readline, startup_trace)
 
 
 class Console(object):
     def __init__(self, convore):
         self.convore = convore
-        self.convore.on_live_update(self.handle_live_update)
+        self.convore.on_live_batch(self.handle_live_batch)
         self.topic = None
         self.output_topic = None
 
 
     def handle_live_update(self, message):
-        username = message.get('user', {}).get('username', '(unknown)')
-        me = self.convore.get_username()
-        if message.get('kind') != 'message' or username == me:
-            return
+        self.handle_live_batch([message])
 
-        topic = message.get('topic', {})
-        self.set_output_topic(topic.get('id'), async=True)
 
-        output(_format_message(message), async=True)
+    def handle_live_batch(self, messages):
+        me = self.convore.get_username()
+        lines = []
+        for message in messages:
+            username = message.get('user', {}).get('username', '(unknown)')
+            if message.get('kind') != 'message' or username == me:
+                continue
+            header = self._topic_header(message.get('topic', {}).get('id'))
+            if header:
+                lines.append(header)
+            lines.append(_format_message(message))
+        if lines:
+            output('\n'.join(lines), async=True)
 
 
     def loop(self):
+        init_readline()
         output('welcome to convoread! type /help for more info')
+        if self.convore.has_cached_data():
+            self.cmd_ts()
+            startup_trace.mark('cached topics')
+        self.convore.set_ready()
+        startup_trace.mark('prompt')
+        startup_trace.report()
         while True:
             try:
                 data = raw_input(config['PROMPT'])
@@ -90,39 +107,33 @@ class Console(object):
 
 
     def cmd_ts(self, group_slug=None):
-        def latest_message(x):
-            return x.get('date_latest_message')
-
         try:
-            all_topics = list(self.convore.get_topics().values())
-            groups = list(self.convore.get_groups().values())
+            if group_slug:
+                group = self.convore.get_group_by_slug(group_slug)
+                if not group:
+                    error('group "{0}" not found'.format(group_slug))
+                    return
+                listing = [(group, self.convore.list_group_topics(
+                                       group.get('id')))]
+            else:
+                unread = {}
+                for topic in self.convore.list_unread_topics():
+                    unread.setdefault(topic.get('group'), []).append(topic)
+                listing = [(group, unread.get(group.get('id'), []))
+                           for group in self.convore.list_groups()]
         except NetworkError, e:
             error(unicode(e))
             return
 
-        if group_slug:
-            groups = [g for g in groups
-                        if g.get('slug') == group_slug]
-            if not groups:
-                error('group "{0}" not found'.format(group_slug))
-                return
-
-        groups = sorted(groups, key=latest_message, reverse=True)
-
-        for group in groups:
+        for group, topics in listing:
             output('{name}:'.format(
                 name=group.get('slug', '(unknown)')))
-            topics = [t for t in all_topics
-                        if t.get('group') == group.get('id')]
-            topics = sorted(topics, key=latest_message, reverse=True)
             for topic in topics:
-                unread = topic.get('unread', 0)
-                if not group_slug and unread == 0:
-                    continue
+                unread_count = topic.get('unread', 0)
                 msg = '  {mark} {id:6} {new:2} {name}'.format(
                     mark='*' if topic.get('id') == self.topic else ' ',
                     id=topic.get('id', '?'),
-                    new=unread if unread > 0 else '',
+                    new=unread_count if unread_count > 0 else '',
                     name=topic.get('name', '(unknown)'))
                 output(msg)
 
@@ -130,7 +141,13 @@ class Console(object):
     def cmd_t(self, topic_id=None):
         count = 10
         if topic_id:
+            try:
+                topic_id = int(topic_id)
+            except ValueError:
+                error('bad topic "{0}"'.format(topic_id))
+                return
             self.topic = topic_id
+            self.convore.set_active_topic(topic_id)
         else:
             if self.topic:
                 topic_id = self.topic
@@ -151,12 +168,10 @@ class Console(object):
     def cmd_m(self, group_slug=None):
         try:
             if group_slug:
-                groups = [g for g in self.convore.get_groups().values()
-                            if g.get('slug') == group_slug]
-                if not groups:
+                group = self.convore.get_group_by_slug(group_slug)
+                if not group:
                     error('group "{0}" not found'.format(group_slug))
                     return
-                group = groups[0]
                 self.convore.mark_group_read(group.get('id'))
             else:
                 self.convore.mark_all_read()
@@ -164,6 +179,45 @@ class Console(object):
             error(unicode(e))
 
 
+    def cmd_stats(self):
+        stats = self.convore.get_stats()
+        for name in sorted(stats):
+            values = stats[name]
+            if 'histograms' in values:
+                _output_metrics(name, values)
+                continue
+            output('{0}: {1}'.format(name, ', '.join(
+                '{0}={1}'.format(key, _format_value(values[key]))
+                for key in sorted(values))))
+        messages = stats['messages']
+        requests = messages['hits'] + messages['misses']
+        if requests:
+            output('messages hit rate: {0:.0%}'.format(
+                float(messages['hits']) / requests))
+
+
+    def cmd_search(self, word, *words):
+        words = (word,) + words
+        group = None
+        if len(words) > 1:
+            try:
+                group = self.convore.get_group_by_slug(words[-1])
+            except NetworkError:
+                pass
+            if group:
+                words = words[:-1]
+        results = self.convore.search(' '.join(words),
+                                      group.get('id') if group else None)
+        if not results:
+            output('no messages found')
+            return
+        self.output_topic = None
+        for message in results:
+            self.set_output_topic(message.get('topic', {}).get('id'))
+            output(_format_message(message))
+        self.output_topic = None
+
+
     def cmd_help(self):
         output('''\
 commands:
@@ -171,6 +225,9 @@ commands:
   /ts [name]  list unread topics or topics in group <name>
   /t [num]    set the posting topic to <num> and list recent messages
   /m [name]   mark messages as read (all or in group <name>)
+  /search <words> [name]
+              search fetched and live messages (all or in group <name>)
+  /stats      show cache sizes, hit rates, latencies and throughput
   /help       show help on commands
   /q          quit
   <text>      post a new message to the selected topic
@@ -183,18 +240,23 @@ keys:
 
 
     def set_output_topic(self, topic_id, async=False):
+        header = self._topic_header(topic_id)
+        if header:
+            output(header, async=async)
+
+
+    def _topic_header(self, topic_id):
         if topic_id == self.output_topic:
-            return
+            return None
         self.output_topic = topic_id
 
-        topic = self.convore.get_topics().get(topic_id, {})
-        group = self.convore.get_groups().get(topic.get('group'), {})
+        topic = self.convore.get_topic(topic_id) or {}
+        group = self.convore.get_group(topic.get('group')) or {}
 
-        output('\n*** topic {group}/{id}: {name}'.format(
+        return '\n*** topic {group}/{id}: {name}'.format(
                     group=group.get('slug', '(unkonwn)'),
                     id=topic_id,
-                    name=topic.get('name', '(unknown)')),
-               async=async)
+                    name=topic.get('name', '(unknown)'))
 
 
     def sendmsg(self, msg):
@@ -204,11 +266,12 @@ keys:
         msg = msg.strip()
         if not msg:
             return
-        debug('sending "{0}"...'.format(msg))
-        try:
-            self.convore.send_message(self.topic, msg)
-        except NetworkError, e:
-            error(unicode(e))
+        debug('sending "{0}"...', msg)
+        self.convore.send_message(self.topic, msg)
+        self.set_output_topic(self.topic)
+        output(_format_message(Message(
+                user=User(username=self.convore.get_username()),
+                message=msg, _ts=time.time())))
 
 
 def _format_message(msg):
@@ -223,3 +286,31 @@ def _format_message(msg):
             time=created.strftime('%H:%M'),
             body=wrap_string(body, indent=6).lstrip())
 
+
+def _format_value(value):
+    if isinstance(value, float):
+        return '{0:.1f}'.format(value)
+    return value
+
+
+def _output_metrics(name, metrics):
+    uptime = metrics['uptime']
+    counters = metrics['counters']
+    rates = metrics['rates']
+    output('{0}: uptime={1:.0f}s, {2}'.format(name, uptime, ', '.join(
+        '{0}={1}'.format(key, counters[key]) for key in sorted(counters))))
+    for key in sorted(rates):
+        output('  {0}: {1:.1f}/s'.format(key, rates[key]))
+    histograms = metrics['histograms']
+    for key in sorted(histograms):
+        h = histograms[key]
+        output('  {0}: n={1} mean={2} p50={3} p90={4} p99={5} max={6}'.format(
+            key, h['count'], _format_time(h['mean']), _format_time(h['p50']),
+            _format_time(h['p90']), _format_time(h['p99']),
+            _format_time(h['max'])))
+
+
+def _format_time(secs):
+    if secs < 1:
+        return '{0:.1f}ms'.format(secs * 1000)
+    return '{0:.2f}s'.format(secs)
@@ -23,138 +23,613 @@
 from __future__ import unicode_literals, print_function
 
 import base64
+import errno
 import json
+import re
 import time
-from httplib import (HTTPSConnection, HTTPException, CannotSendRequest,
-                     BadStatusLine)
+import zlib
+from httplib import (HTTPConnection, HTTPSConnection, HTTPException,
+                     CannotSendRequest, BadStatusLine)
 from urllib import urlencode
+import select
 import socket
-from contextlib import closing
-from threading import Thread
+import ssl
+from contextlib import contextmanager
+from itertools import chain, count
+from threading import Thread, Lock, Event
+from Queue import Queue, Empty
 
-from convoread.utils import debug, error, get_passwd, synchronized
+from convoread.cache import Cache
+from convoread.jsonstream import iter_batches
+from convoread.config import config
+from convoread.messages import MessageStore
+from convoread.metrics import metrics, endpoint
+from convoread.models import Group, Message, Topic
+from convoread.outbox import Outbox
+from convoread.search import SearchIndex
+from convoread.utils import (error, get_passwd, synchronized, Logger,
+                             lazy, base_url, Backoff, startup_trace)
 
 
 NETWORK_ENCODING = 'UTF-8'
 
+log = Logger('connection')
+live_log = Logger('live')
+
 
 class NetworkError(Exception):
-    pass
+    '''A request to the server failed.
+
+    The `kind` of the error is one of 'dns', 'reset' (the connection was
+    dropped), 'socket', 'server' (an HTTP error `status`) or 'protocol'.
+    '''
+    def __init__(self, msg, kind='protocol', status=None):
+        Exception.__init__(self, msg)
+        self.kind = kind
+        self.status = status
+
+
+    def is_retryable(self):
+        '''Return True if the request may succeed if it is made again.'''
+        status = self.status
+        return status is None or status >= 500 or status in (408, 429)
 
 
 class Convore(object):
+    '''Convore API client with a local copy of groups and topics.
+
+    Network requests are never made while holding the lock. The groups and
+    topics dicts returned to callers are snapshots: they are replaced by
+    updated copies instead of being modified in place, so readers don't need
+    any locking.
+
+    Lookups by slug, topics by group and the unread topics are served from
+    indexes that are published together with the snapshots. Live messages
+    update them incrementally, including the unread counters. The counters
+    are checked against the server periodically and only groups that don't
+    match are refetched.
+    '''
     def __init__(self):
-        self._connection = Connection()
-        self._live = Live()
-        self._live.on_update(self._handle_live_update)
-        self._topics = {}
-        self._groups = {}
+        self._username, _ = get_passwd()
+        # Connections are opened on demand or in the background after
+        # `set_ready`, so nothing waits for the network before the prompt
+        self._pool = ConnectionPool(config['POOL_SIZE'],
+                                    self._create_connection)
+        self._ready = False
+        self._cache = Cache()
+        self._groups, self._topics, messages = self._cache.load(
+                self.get_username())
+        startup_trace.mark('cache')
+        self._messages = MessageStore(config['CACHE_MESSAGES'], messages,
+                                      config['CACHE_TOTAL_MESSAGES'],
+                                      config['CACHE_TOPICS'])
+        self._reindex()
+        self._search = SearchIndex()
+        for topic_id, topic_messages in messages.items():
+            self._search.add(topic_id, self._group_of(topic_id),
+                             topic_messages)
+        startup_trace.mark('search queue')
+        self._outbox = Outbox(self._post_message, _is_retryable)
+        self._active_topic = None
+        self._active_unseen = False
+        self._stats_callbacks = []
+        self._closed = Event()
+        self._live = self._create_live()
+        self._live.on_update(self._handle_live_batch, batch=True)
+        thread = Thread(target=self._reconcile_loop)
+        thread.daemon = True
+        thread.start()
+
+
+    def has_cached_data(self):
+        return bool(self._groups and self._topics)
 
 
-    @synchronized
     def get_username(self):
-        return self._connection.username
+        return self._username
 
 
-    @synchronized
     def get_groups(self, force=False):
-        if self._groups and not force:
-            return self._groups
+        groups = self._groups
+        if groups and not force:
+            return groups
         url = '/api/groups.json'
-        response = self._connection.request('GET', url)
-        for group in response.get('groups', []):
-            self._groups[group.get('id')] = group
-        return self._groups
+        response = self._request('GET', url)
+        groups = dict((group.get('id'), Group.from_json(group))
+                      for group in response.get('groups', []))
+        self._set_groups(groups)
+        return groups
 
 
-    @synchronized
     def get_topics(self, force=False):
-        if self._topics and not force:
-            return self._topics
-        for group in self.get_groups():
-            self._topics.update(self.get_group_topics(group))
-        return self._topics
+        topics = self._topics
+        if topics and not force:
+            return topics
+        groups = self.get_groups()
+        results, errors = self._fetch_topics(list(groups))
+        for group_id, e in errors.items():
+            error('cannot get topics of group "{0}": {1}'.format(
+                      groups[group_id].get('slug', group_id), e))
+        if errors and not results and not self._topics:
+            raise NetworkError('cannot get topics')
+        topics = {}
+        for group_topics in results.values():
+            topics.update(group_topics)
+        return self._update_topics(topics)
 
 
-    @synchronized
     def get_group_topics(self, group_id):
-        result = {}
-        url = '/api/groups/{0}/topics.json'.format(group_id)
-        response = self._connection.request('GET', url)
-        for topic in response.get('topics', []):
-            topic['group'] = group_id
-            result[topic.get('id')] = topic
-        return result
+        with self._pool.connection() as connection:
+            return _fetch_group_topics(connection, group_id)
 
 
-    @synchronized
-    def get_topic_messages(self, topic_id):
-        url = '/api/topics/{0}/messages.json'.format(topic_id)
-        messages = self._connection.request('GET', url).get('messages', [])
+    def get_group(self, group_id):
+        '''Return the group with the given id or None.'''
+        return self.get_groups().get(group_id)
 
-        topic = self.get_topics().get(topic_id, {})
-        unread = topic.get('unread', 0)
-        group = self.get_groups().get(topic.get('group'), {})
-        group['unread'] = max(group.get('unread', 0) - unread, 0)
-        topic['unread'] = 0
 
+    def get_topic(self, topic_id):
+        '''Return the topic with the given id or None.'''
+        return self.get_topics().get(topic_id)
+
+
+    def get_group_by_slug(self, slug):
+        '''Return the group with the given slug or None.'''
+        groups = self.get_groups()
+        return groups.get(self._slugs.get(slug))
+
+
+    def list_groups(self):
+        '''Return groups, most recently active first.'''
+        groups = self.get_groups()
+        return [groups[id] for id in self._group_order if id in groups]
+
+
+    def list_group_topics(self, group_id):
+        '''Return known topics of a group, most recently active first.'''
+        topics = self.get_topics()
+        return [topics[id] for id in self._group_topics.get(group_id, ())
+                if id in topics]
+
+
+    def list_unread_topics(self):
+        '''Return unread topics, most recently active first.'''
+        topics = self.get_topics()
+        return [topics[id] for id in self._unread if id in topics]
+
+
+    def get_topic_messages(self, topic_id):
+        '''Return recent messages of a topic and mark the topic as read.
+
+        Messages of topics fetched earlier are kept up to date by the live
+        stream, so they are returned without any requests.
+        '''
+        messages = self._messages.get(topic_id)
+        if messages is None:
+            url = '/api/topics/{0}/messages.json'.format(topic_id)
+            self._messages.start_fetch(topic_id)
+            try:
+                messages = [Message.from_json(m) for m in
+                            self._request_items('GET', url, 'messages')]
+            except Exception:
+                self._messages.cancel_fetch(topic_id)
+                raise
+            self._search.add(topic_id, self._group_of(topic_id), messages)
+            messages = self._messages.merge(topic_id, messages)
+        elif self.get_topics().get(topic_id, {}).get('unread'):
+            thread = Thread(target=self._mark_topic_read, args=(topic_id,))
+            thread.daemon = True
+            thread.start()
+        self.get_topics()
+        self._set_topic_read(topic_id)
         return messages
 
 
-    @synchronized
+    def search(self, query, group_id=None):
+        '''Return fetched and live messages matching `query`, best first.'''
+        return self._search.search(query, group_id)
+
+
+    def get_recent_users(self):
+        '''Return the users who posted the cached recent messages.'''
+        users = {}
+        for messages in self._messages.snapshot().values():
+            for message in messages:
+                user = message.get('user', {})
+                users[user.get('username')] = user
+        return list(users.values())
+
+
     def send_message(self, topic, msg):
-        url = '/api/topics/{0}/messages/create.json'.format(topic)
-        data = msg.encode(NETWORK_ENCODING, 'replace')
-        self._connection.request('POST', url, params={'message': data})
+        '''Queue a message for sending, it is sent in the background.'''
+        self._outbox.put(topic, msg)
 
 
-    @synchronized
     def on_live_update(self, callback):
+        '''Call `callback(message)` for every live message.'''
         self._live.on_update(callback)
 
 
-    @synchronized
+    def on_live_batch(self, callback, raw=False):
+        '''Call `callback(messages)` for all messages of a live poll.
+
+        Raw callbacks get the decoded JSON dicts with all the fields sent by
+        the server instead of `Message` objects.
+        '''
+        self._live.on_update(callback, batch=True, raw=raw)
+
+
+    def on_stats(self, name, callback):
+        '''Include the dict returned by `callback()` in `get_stats`.'''
+        self._stats_callbacks.append((name, callback))
+
+
+    def set_live_cursor(self, cursor):
+        '''Resume the live stream after the message with id `cursor`.'''
+        self._live.set_cursor(cursor)
+
+
+    def set_active_topic(self, topic_id):
+        '''Set the topic the user reads, its live messages are not unread.'''
+        self._active_topic = topic_id
+
+
+    def set_ready(self):
+        '''Start the live stream once the user interface is ready.'''
+        if self._ready:
+            return
+        self._ready = True
+        self._pool.start(config['POOL_WARM'], config['POOL_PROBE_INTERVAL'])
+        self._live.set_ready()
+
+
+    def get_live_stats(self):
+        return self._live.stats()
+
+
+    def get_stats(self):
+        '''Return a dict of statistics dicts by subsystem.'''
+        groups, topics = self._snapshot()
+        stats = {
+            'state': {
+                'groups': len(groups),
+                'topics': len(topics),
+                'unread_topics': len(self._unread),
+            },
+            'messages': self._messages.stats(),
+            'responses': response_cache.stats(),
+            'live': self.get_live_stats(),
+            'outbox': self._outbox.stats(),
+            'pool': self._pool.stats(),
+            'search': self._search.stats(),
+            'metrics': metrics.snapshot(),
+        }
+        for name, callback in self._stats_callbacks:
+            stats[name] = callback()
+        return stats
+
+
     def close(self):
-        self._connection.close()
+        self._closed.set()
+        self._outbox.close()
+        self._search.close()
+        self._save_cache()
+        self._pool.close()
         self._live.close()
 
 
-    @synchronized
     def mark_all_read(self):
         url = '/api/account/mark_read.json'
-        self._connection.request('POST', url)
-        for topic in self.get_topics().values():
-            topic['unread'] = 0
+        self._request('POST', url)
+        self.get_topics()
+        self._set_read(lambda group_id: True)
 
 
-    @synchronized
     def mark_group_read(self, group_id):
         url = '/api/groups/{0}/mark_read.json'.format(group_id)
-        self._connection.request('POST', url)
-        for topic in self.get_topics().values():
-            if topic.get('group') == group_id:
-                topic['unread'] = 0
+        self._request('POST', url)
+        self.get_topics()
+        self._set_read(lambda id: id == group_id)
+
+
+    def _mark_topic_read(self, topic_id):
+        url = '/api/topics/{0}/mark_read.json'.format(topic_id)
+        try:
+            self._request('POST', url)
+        except NetworkError, e:
+            error('cannot mark topic {0} as read: {1}'.format(topic_id, e))
+
+
+    def _group_of(self, topic_id):
+        return self._topics.get(topic_id, {}).get('group')
+
+
+    def _post_message(self, topic_id, msg):
+        url = '/api/topics/{0}/messages/create.json'.format(topic_id)
+        data = msg.encode(NETWORK_ENCODING, 'replace')
+        self._request('POST', url, params={'message': data})
+
+
+    def _request(self, method, url, params=None):
+        with self._pool.connection() as connection:
+            return connection.request(method, url, params)
+
+
+    def _request_items(self, method, url, key, params=None):
+        '''Yield the items of the array `key` in the response one by one.'''
+        with self._pool.connection() as connection:
+            for items in connection.request_items(method, url, key, params):
+                for item in items:
+                    yield item
+
+
+    def _create_connection(self):
+        return Connection()
+
+
+    def _create_live(self):
+        return Live(self._pool)
+
+
+    def _fetch_topics(self, group_ids):
+        return fetch_parallel(self._pool, _fetch_group_topics, group_ids,
+                              config['FETCH_WORKERS'])
 
 
-    @synchronized
     def _handle_live_update(self, message):
-        if message.get('kind') != 'message':
+        self._handle_live_batch([message])
+
+
+    def _handle_live_batch(self, messages):
+        messages = [m for m in messages if m.get('kind') == 'message']
+        if not messages:
             return
 
-        id = message.get('topic', {}).get('id')
-        group_id = message.get('group')
+        groups = self.get_groups()
+        fetched_groups = set()
+        if any(m.get('group') not in groups for m in messages):
+            fetched_groups.update(self.get_groups(force=True))
         topics = self.get_topics()
-        ts = message.get('_ts')
+        unknown = set(m.get('group') for m in messages
+                      if m.get('topic', {}).get('id') not in topics)
+        fetched_topics = set()
+        for group_id in unknown:
+            updates = self.get_group_topics(group_id)
+            fetched_topics.update(updates)
+            self._update_topics(updates)
+        self._apply_live_messages(messages, self.get_username(),
+                                  self._active_topic, fetched_groups,
+                                  fetched_topics)
+        for message in messages:
+            self._search.add(message.get('topic', {}).get('id'),
+                             message.get('group'), [message])
 
-        if id in topics:
-            topics[id]['date_latest_message'] = ts
-        else:
-            group_topics = self.get_group_topics(group_id)
-            topics[id] = group_topics.get(id, {})
-        groups = self.get_groups()
-        if group_id not in groups:
+
+    def _reconcile_loop(self):
+        if self._groups:
+            self._reconcile()
+        while True:
+            self._closed.wait(config['UNREAD_CHECK_INTERVAL'])
+            if self._closed.is_set():
+                return
+            self._check_unread()
+
+
+    def _check_unread(self):
+        '''Refetch topics of groups whose unread counters look wrong.
+
+        The unread counters of groups from the server are compared with the
+        sums of the local counters of their topics.
+        '''
+        if not self._topics:
+            return
+        active = self._active_topic
+        if self._active_unseen and active is not None:
+            # The server doesn't know that the user has seen live messages
+            # of the active topic
+            self._active_unseen = False
+            self._mark_topic_read(active)
+        try:
+            self.get_groups(force=True)
+        except NetworkError, e:
+            log.debug('cannot check unread counters: {0}', e)
+            return
+        suspicious = self._suspicious_groups()
+        if not suspicious:
+            return
+        log.debug('refetching topics of {0} groups', len(suspicious))
+        results, errors = self._fetch_topics(suspicious)
+        for group_id, e in errors.items():
+            log.debug('cannot get topics of group {0}: {1}', group_id, e)
+        self._set_group_topics(results)
+
+
+    def _reconcile(self):
+        try:
             groups = self.get_groups(force=True)
-        groups[group_id]['date_latest_message'] = ts
+            self.get_topics(force=True)
+        except NetworkError, e:
+            error('cannot update cached topics: {0}'.format(e))
+            return
+        self._forget_groups_except(groups)
+        self._save_cache()
+
+
+    def _save_cache(self):
+        groups, topics = self._snapshot()
+        self._cache.save(self.get_username(), groups, topics,
+                         self._messages.snapshot())
+
+
+    # Updates of the local state. They are small, they don't make any network
+    # requests and they publish new snapshots of groups and topics.
+
+    @synchronized
+    def _snapshot(self):
+        return self._groups, self._topics
+
+
+    @synchronized
+    def _set_groups(self, groups):
+        self._groups = groups
+        self._reindex()
+
+
+    @synchronized
+    def _update_topics(self, updates):
+        topics = dict(self._topics)
+        topics.update(updates)
+        self._topics = topics
+        self._reindex()
+        return topics
+
+
+    @synchronized
+    def _set_group_topics(self, results):
+        topics = dict((id, topic) for id, topic in self._topics.items()
+                      if topic.get('group') not in results)
+        for group_topics in results.values():
+            topics.update(group_topics)
+        self._topics = topics
+        self._reindex()
+
+
+    @synchronized
+    def _suspicious_groups(self):
+        topics = self._topics
+        return [id for id, group in self._groups.items()
+                if group.get('unread', 0) != sum(
+                        topics[topic_id].get('unread', 0)
+                        for topic_id in self._group_topics.get(id, ()))]
+
+
+    @synchronized
+    def _forget_groups_except(self, groups):
+        self._topics = dict((id, topic)
+                            for id, topic in self._topics.items()
+                            if topic.get('group') in groups)
+        self._reindex()
+
+
+    @synchronized
+    def _set_topic_read(self, topic_id):
+        topic = self._topics.get(topic_id)
+        if not topic:
+            return
+        group_id = topic.get('group')
+        group = self._groups.get(group_id)
+        if group:
+            unread = max(group.get('unread', 0) - topic.get('unread', 0), 0)
+            self._groups = _replace(self._groups, group_id, unread=unread)
+        self._topics = _replace(self._topics, topic_id, unread=0)
+        self._unread = [id for id in self._unread if id != topic_id]
+
+
+    @synchronized
+    def _set_read(self, group_filter):
+        groups = dict(self._groups)
+        for id, group in groups.items():
+            if group_filter(id):
+                groups[id] = group.replace(unread=0)
+        topics = dict(self._topics)
+        for id, topic in topics.items():
+            if group_filter(topic.get('group')):
+                topics[id] = topic.replace(unread=0)
+        self._groups = groups
+        self._topics = topics
+        self._unread = [id for id in self._unread
+                        if not group_filter(topics[id].get('group'))]
+
+
+    @synchronized
+    def _apply_live_messages(self, messages, username, active_topic,
+                             fetched_groups=(), fetched_topics=()):
+        topics = dict(self._topics)
+        groups = dict(self._groups)
+        group_order = list(self._group_order)
+        group_topics = dict(self._group_topics)
+        unread_ids = list(self._unread)
+        copied = set()
+        for message in messages:
+            topic_id = message.get('topic', {}).get('id')
+            group_id = message.get('group')
+            ts = message.get('_ts')
+            self._messages.add(topic_id, message)
+            own = message.get('user', {}).get('username') == username
+            if topic_id == active_topic and not own:
+                self._active_unseen = True
+            unread = (topic_id in topics and not own and
+                      topic_id != active_topic)
+            # A live message is the latest one, so its topic and group move
+            # to the front of the indexes ordered by the latest message.
+            # Counters of groups and topics fetched after the messages were
+            # posted already include them.
+            if topic_id in topics:
+                if topic_id not in fetched_topics:
+                    topic = topics[topic_id]
+                    topics[topic_id] = topic.replace(
+                            date_latest_message=ts,
+                            unread=topic.get('unread', 0) + int(unread))
+                if group_id not in copied:
+                    group_topics[group_id] = list(
+                            group_topics.get(group_id, ()))
+                    copied.add(group_id)
+                _move_to_front(group_topics[group_id], topic_id)
+                if unread or topic_id in unread_ids:
+                    _move_to_front(unread_ids, topic_id)
+            if group_id in groups:
+                if group_id not in fetched_groups:
+                    group = groups[group_id]
+                    groups[group_id] = group.replace(
+                            date_latest_message=ts,
+                            unread=group.get('unread', 0) + int(unread))
+                _move_to_front(group_order, group_id)
+        self._topics = topics
+        self._groups = groups
+        self._group_order = group_order
+        self._group_topics = group_topics
+        self._unread = unread_ids
+
+
+    @synchronized
+    def _reindex(self):
+        groups, topics = self._groups, self._topics
+
+        def latest_group(id):
+            return groups[id].get('date_latest_message')
+
+        def latest_topic(id):
+            return topics[id].get('date_latest_message')
+
+        group_topics = {}
+        for id, topic in topics.items():
+            group_topics.setdefault(topic.get('group'), []).append(id)
+        for ids in group_topics.values():
+            ids.sort(key=latest_topic, reverse=True)
+        self._slugs = dict((group.get('slug'), id)
+                           for id, group in groups.items())
+        self._group_order = sorted(groups, key=latest_group, reverse=True)
+        self._group_topics = group_topics
+        self._unread = sorted((id for id, topic in topics.items()
+                               if topic.get('unread', 0) > 0),
+                              key=latest_topic, reverse=True)
+
+
+def _is_retryable(e):
+    return isinstance(e, NetworkError) and e.is_retryable()
+
+
+def _move_to_front(ids, id):
+    if id in ids:
+        ids.remove(id)
+    ids.insert(0, id)
+
+
+def _replace(items, id, **fields):
+    '''Return a copy of `items` with the fields of `items[id]` updated.'''
+    result = dict(items)
+    result[id] = items[id].replace(**fields)
+    return result
 
 
 class Connection(object):
@@ -163,113 +638,768 @@ class Connection(object):
         # storing them, we will turn them into arguments
         login, password = get_passwd()
         self.username = login
-        self.http = HTTPSConnection('convore.com')
+        secure, host, port = base_url()
+        if secure:
+            self.http = HTTPSConnection(host, port)
+        else:
+            self.http = HTTPConnection(host, port)
         self._headers = {
             b'Authorization': authheader(login, password),
+            b'Accept-Encoding': b'gzip, deflate',
         }
+        self._aborted = False
 
 
     def request(self, method, url, params=None):
+        with measure_request(method, url):
+            return self._request(method, url, params)
+
+
+    def request_items(self, method, url, key, params=None):
+        '''Yield lists of the items of the array `key` in the JSON response.
+
+        The body is decoded as it is received, so only a block of data and
+        the items completed by it are in memory at a time. Other fields of
+        the response are ignored.
+        '''
+        timer = RequestTimer(method, url)
+        try:
+            with timer.measure():
+                r, url, cacheable = self._send(method, url, params)
+                if r.status // 100 != 2:
+                    status, data = self._read_body(r, url, cacheable)
+                    check_status(status, r.reason)
+                    chunks = [data]
+                else:
+                    blocks = timer.timed(self._read_blocks(r))
+                    chunks = iter_decompress(counted(blocks),
+                                             r.getheader('Content-Encoding'))
+                    if cacheable:
+                        chunks = response_cache.tee(
+                                url, r.getheader('ETag'),
+                                r.getheader('Last-Modified'), chunks)
+            done = False
+            try:
+                for items in iter_batches(chunks, key):
+                    yield items
+                done = True
+            except ValueError, e:
+                raise timer.failed(NetworkError(
+                        'bad server response: {0}'.format(e)))
+            finally:
+                # The rest of an abandoned response is never read
+                if not done:
+                    self.http.close()
+        finally:
+            timer.record()
+
+
+    def _request(self, method, url, params=None):
+        r, url, cacheable = self._send(method, url, params)
+        status, data = self._read_body(r, url, cacheable)
+        return decode_response(status, r.reason, data)
+
+
+    def _send(self, method, url, params):
+        '''Send a request, return `(response, url, cacheable)`.'''
         body = None
+        cacheable = method == 'GET' and is_cacheable(url)
         if params:
             if method == 'GET':
                 url = '{path}?{params}'.format(path=url,
                                                params=urlencode(params))
             else:
                 body = urlencode(params)
-        debug('GET {0} HTTP/1.1'.format(url))
+        log.debug('{0} {1} HTTP/1.1', method, url)
+        headers = dict(self._headers)
+        if cacheable:
+            headers.update(response_cache.validators(url))
 
-        def _request():
-            self.http.request(method, url, body, headers=self._headers)
+        def send():
+            self.http.request(method, url, body, headers=headers)
             return self.http.getresponse()
 
+        if body:
+            metrics.increment('http.bytes_out', len(body))
         try:
             try:
-                r = _request()
+                r = send()
             except (CannotSendRequest, BadStatusLine), e:
-                debug('exception {0}, reconnecting...'.format(e))
+                if self._aborted:
+                    raise
+                log.debug('exception {0}, reconnecting...', e)
                 self.http.close()
                 self.http.connect()
-                r = _request()
+                r = send()
         except HTTPException, e:
             self.http.close()
+            kind = 'reset' if isinstance(e, BadStatusLine) else 'protocol'
             raise NetworkError('HTTP request error: {0}'.format(
-                    type(e).__name__))
-        except socket.gaierror:
-            msg = 'cannot get network address for "{host}"'.format(
-                    host=self.http.host)
-            raise NetworkError(msg)
+                    type(e).__name__), kind)
         except socket.error, e:
             self.http.close()
-            raise NetworkError(e.args[1])
+            raise socket_error(e, self.http.host)
+
+        log.debug('HTTP/1.1 {0} {1}', r.status, r.reason, url=url)
+        return r, url, cacheable
 
-        status_msg = '{status} {reason}'.format(status=r.status,
-                                                reason=r.reason)
-        debug('HTTP/1.1 {0}'.format(status_msg))
-        if r.status // 100 != 2:
+
+    def _read_body(self, r, url, cacheable):
+        '''Return `(status, body)` of a response, using the cache on 304.'''
+        status = r.status
+        if status == 304 and cacheable:
+            r.read()
+            data = response_cache.get(url)
+            status = 200 if data is not None else status
+        elif status // 100 != 2:
             self.http.close()
-            raise NetworkError('server error: {0}'.format(status_msg))
+            data = b''
+        else:
+            data = decompress(counted(self._read_blocks(r)),
+                              r.getheader('Content-Encoding'))
+            if cacheable:
+                response_cache.put(url, r.getheader('ETag'),
+                                   r.getheader('Last-Modified'), data)
+        return status, data
+
+
+    def _read_blocks(self, r):
+        '''Yield blocks of a response body as they are received.'''
+        while True:
+            try:
+                block = r.read(BLOCK_SIZE)
+            except (HTTPException, socket.error), e:
+                self.http.close()
+                raise NetworkError('HTTP read error: {0}'.format(
+                        type(e).__name__), 'reset')
+            if not block:
+                return
+            yield block
+
 
+    def connect(self):
+        '''Open the connection in advance, e.g. for the TLS handshake.'''
         try:
-            data = r.read().decode(NETWORK_ENCODING)
-            res = json.loads(data)
-            debug('response in JSON\n{msg}'.format(
-                msg=json.dumps(res, ensure_ascii=False, indent=4)))
-            return res
-        except ValueError:
-            raise NetworkError('bad server response: {0}'.format(data))
+            self.http.connect()
+        except HTTPException, e:
+            self.http.close()
+            raise NetworkError('HTTP connection error: {0}'.format(
+                    type(e).__name__))
+        except socket.error, e:
+            self.http.close()
+            raise socket_error(e, self.http.host)
+
+
+    def is_alive(self):
+        '''Return True if the idle connection is open.
+
+        An idle keep-alive socket becomes readable when the server closes it.
+        A TLS 1.3 socket is also readable when the server has sent session
+        tickets after the handshake, so it is read to tell the two apart.
+        '''
+        sock = self.http.sock
+        if sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error):
+            return False
+        if not readable:
+            return True
+        if not isinstance(sock, ssl.SSLSocket):
+            return False
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            # Both EOF and unexpected data make the connection unusable
+            sock.recv(1)
+        except ssl.SSLError, e:
+            return e.args[0] == ssl.SSL_ERROR_WANT_READ
+        except socket.error:
+            return False
+        finally:
+            sock.settimeout(timeout)
+        return False
 
 
     def close(self):
         self.http.close()
 
 
-class Live(Thread):
+    def abort(self):
+        '''Break off a request made by another thread.'''
+        # Unlike `close`, shutting the socket down wakes a blocked read
+        self._aborted = True
+        sock = self.http.sock
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class ConnectionPool(object):
+    '''A bounded pool of keep-alive connections to the API host.
+
+    Connections are made by `factory` on demand up to `size` and are reused
+    after being released. All connections go to the same host, so `size` is
+    the limit of connections per host.
+
+    After `start` a background thread opens some connections in advance and
+    reopens idle connections closed by the server, so requests rarely wait
+    for a TCP and TLS handshake.
+    '''
+    def __init__(self, size, factory=Connection):
+        self._size = max(size, 1)
+        self._factory = factory
+        self._created = 0
+        self._idle = Queue()
+        self._lock = Lock()
+        self._closed = Event()
+        self.reopened = 0
+
+
+    def start(self, warm, interval):
+        thread = Thread(target=self._maintain, args=(warm, interval),
+                        name='pool')
+        thread.daemon = True
+        thread.start()
+
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        connection = self._create()
+        if connection is not None:
+            return connection
+        return self._idle.get()
+
+
+    def release(self, connection):
+        self._idle.put(connection)
+
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'created': self._created,
+            'idle': self._idle.qsize(),
+            'reopened': self.reopened,
+        }
+
+
+    def close(self):
+        self._closed.set()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+
+
+    def _create(self):
+        with self._lock:
+            if self._created >= self._size:
+                return None
+            self._created += 1
+        return self._factory()
+
+
+    def _maintain(self, warm, interval):
+        for _ in range(warm):
+            connection = self._create()
+            if connection is None:
+                break
+            self._open(connection)
+            self.release(connection)
+        startup_trace.mark('warm connections')
+        while True:
+            self._closed.wait(interval)
+            if self._closed.is_set():
+                return
+            self.probe()
+
+
+    def probe(self):
+        '''Reopen idle connections closed by the server.'''
+        for _ in range(self._idle.qsize()):
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                return
+            if not connection.is_alive():
+                connection.close()
+                if self._open(connection):
+                    self.reopened += 1
+            self.release(connection)
+
+
+    def _open(self, connection):
+        try:
+            connection.connect()
+            return True
+        except NetworkError, e:
+            log.debug('cannot open connection: {0}', e)
+            return False
+
+
+def fetch_parallel(pool, f, items, workers):
+    '''Call `f(connection, item)` for each item using up to `workers` threads.
+
+    Returns a pair of dicts `(results, errors)` keyed by item. A failure of one
+    item doesn't affect the others.
+    '''
+    results = {}
+    errors = {}
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                with pool.connection() as connection:
+                    results[item] = f(connection, item)
+            except NetworkError, e:
+                errors[item] = e
+
+    threads = [Thread(target=worker)
+               for _ in range(min(max(workers, 1), len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class ResponseCache(object):
+    '''Bodies of GET responses together with their HTTP validators.
+
+    Used for conditional requests: if the server responds with 304 Not
+    Modified, the cached body is used instead. Bodies take at most
+    `max_bytes`, the least recently used ones are dropped first. Bodies
+    bigger than an eighth of that are not kept, so a few big responses
+    don't push out all the others.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_bytes // 8
+        # Entries are lists `[etag, last_modified, body, last_used]`
+        self._entries = {}
+        self._bytes = 0
+        self._clock = count()
+        self._lock = Lock()
+        self.hits = 0
+
+
+    def validators(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry:
+                entry[3] = next(self._clock)
+        headers = {}
+        if entry:
+            etag, last_modified, _, _ = entry
+            if etag:
+                headers[b'If-None-Match'] = etag
+            if last_modified:
+                headers[b'If-Modified-Since'] = last_modified
+        return headers
+
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry:
+                entry[3] = next(self._clock)
+                self.hits += 1
+        return entry[2] if entry else None
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+            }
+
+
+    def put(self, url, etag, last_modified, body):
+        with self._lock:
+            self._remove(url)
+            if not etag and not last_modified:
+                return
+            if len(body) > self.max_entry_size:
+                return
+            self._entries[url] = [etag, last_modified, body,
+                                  next(self._clock)]
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._remove(min(self._entries,
+                                 key=lambda url: self._entries[url][3]))
+
+
+    def tee(self, url, etag, last_modified, chunks):
+        '''Yield `chunks` of a body and cache it if it is small enough.'''
+        parts = []
+        size = 0
+        for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size > self.max_entry_size:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is None:
+            with self._lock:
+                self._remove(url)
+        else:
+            self.put(url, etag, last_modified, b''.join(parts))
+
+
+    def _remove(self, url):
+        # Called with the lock held
+        entry = self._entries.pop(url, None)
+        if entry:
+            self._bytes -= len(entry[2])
+
+
+response_cache = ResponseCache(config['RESPONSE_CACHE_BYTES'])
+
+_CACHEABLE_URL = re.compile(r'^/api/(groups|groups/\d+/topics|'
+                            r'topics/\d+/messages)\.json$')
+
+BLOCK_SIZE = 16 * 1024
+
+
+def is_cacheable(url):
+    return bool(_CACHEABLE_URL.match(url))
+
+
+@contextmanager
+def measure_request(method, url):
+    '''Record the latency and the network errors of an API request.'''
+    started = time.time()
+    try:
+        yield
+    except NetworkError, e:
+        metrics.increment('http.errors.' + e.kind)
+        raise
+    finally:
+        metrics.observe('http ' + endpoint(method, url),
+                        time.time() - started)
+
+
+class RequestTimer(object):
+    '''Record the network time and errors of a request read in parts.
+
+    Only sending the request and reading the response count, not the time
+    spent between reads by the consumer of the response.
+    '''
+    def __init__(self, method, url):
+        self.name = 'http ' + endpoint(method, url)
+        self.elapsed = 0.0
+
+
+    @contextmanager
+    def measure(self):
+        started = time.time()
+        try:
+            yield
+        except NetworkError, e:
+            self.failed(e)
+            raise
+        finally:
+            self.elapsed += time.time() - started
+
+
+    def timed(self, blocks):
+        '''Yield `blocks`, measuring the time it takes to get each one.'''
+        blocks = iter(blocks)
+        while True:
+            with self.measure():
+                block = next(blocks, None)
+            if block is None:
+                return
+            yield block
+
+
+    def failed(self, e):
+        '''Count the `NetworkError` `e` and return it.'''
+        metrics.increment('http.errors.' + e.kind)
+        return e
+
+
+    def record(self):
+        metrics.observe(self.name, self.elapsed)
+
+
+def counted(chunks):
+    '''Yield chunks of a response body, counting the bytes received.'''
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    metrics.increment('http.bytes_in', size)
+
+
+def decompress(chunks, encoding):
+    '''Join chunks of a response body, decompressing them on the fly.'''
+    return b''.join(iter_decompress(chunks, encoding))
+
+
+def iter_decompress(chunks, encoding):
+    '''Yield decompressed chunks of a response body.'''
+    encoding = (encoding or '').strip().lower()
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decompressor = zlib.decompressobj()
+    else:
+        for chunk in chunks:
+            yield chunk
+        return
+    try:
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+    except zlib.error, e:
+        raise NetworkError('bad compressed response: {0}'.format(e))
+
+
+_RESET_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+def socket_error(e, host):
+    '''Convert a socket exception into a `NetworkError`.'''
+    if isinstance(e, socket.gaierror):
+        return NetworkError('cannot get network address for "{0}"'.format(
+                host), 'dns')
+    if isinstance(e, socket.timeout):
+        return NetworkError('timed out', 'socket')
+    kind = 'reset' if e.args and e.args[0] in _RESET_ERRNOS else 'socket'
+    return NetworkError(e.args[-1] if e.args else type(e).__name__, kind)
+
+
+def check_status(status, reason):
+    if status // 100 != 2:
+        raise NetworkError('server error: {status} {reason}'.format(
+                status=status, reason=reason), 'server', status)
+
+
+def decode_response(status, reason, data):
+    '''Check the HTTP status of a response and decode its JSON body.'''
+    check_status(status, reason)
+    try:
+        data = data.decode(NETWORK_ENCODING)
+        res = json.loads(data)
+        log.debug('response in JSON\n{0}',
+                  lazy(json.dumps, res, ensure_ascii=False, indent=4))
+        return res
+    except ValueError:
+        raise NetworkError('bad server response: {0}'.format(data))
+
+
+def group_topics_url(group_id):
+    return '/api/groups/{0}/topics.json'.format(group_id)
+
+
+def _fetch_group_topics(connection, group_id):
+    batches = connection.request_items('GET', group_topics_url(group_id),
+                                       'topics')
+    return parse_group_topics(group_id, chain.from_iterable(batches))
+
+
+def parse_group_topics(group_id, topics):
+    result = {}
+    for topic in topics:
+        topic['group'] = group_id
+        result[topic.get('id')] = Topic.from_json(topic)
+    return result
+
+
+class ReconnectScheduler(object):
+    '''Delays between reconnection attempts of the live stream.
+
+    A connection dropped for the first time is resumed at once. Other
+    failures are retried with exponential backoff and jitter, starting with
+    longer delays for errors that are unlikely to go away quickly.
+    '''
+    min_delays = {
+        'reset': 0.0,
+        'socket': 0.5,
+        'protocol': 1.0,
+        'server': 2.0,
+        'dns': 5.0,
+    }
+
     def __init__(self):
-        self._connection = Connection()
+        self._backoff = Backoff(config['LIVE_BACKOFF_BASE'],
+                                config['LIVE_BACKOFF_MAX'])
+        self._down_since = None
+        self.reconnects = 0
+        self.disconnected_time = 0.0
+
+
+    def failure(self, e):
+        '''Return the delay before the next attempt after error `e`.'''
+        if self._down_since is None:
+            self._down_since = time.time()
+            if e.kind == 'reset':
+                return 0.0
+        delay = self.min_delays.get(e.kind, 1.0) + self._backoff.next()
+        return min(delay, self._backoff.cap)
+
+
+    def success(self):
+        if self._down_since is not None:
+            self.disconnected_time += time.time() - self._down_since
+            self._down_since = None
+            self.reconnects += 1
+            metrics.increment('live.reconnects')
+        self._backoff.reset()
+
+
+    def stats(self):
+        disconnected_time = self.disconnected_time
+        if self._down_since is not None:
+            disconnected_time += time.time() - self._down_since
+        return {
+            'connected': self._down_since is None,
+            'reconnects': self.reconnects,
+            'disconnected_time': disconnected_time,
+        }
+
+
+class Live(Thread):
+    def __init__(self, pool):
+        self._pool = pool
+        self._cursor = None
         self._callbacks = []
+        self._connection = None
+        self._ready = Event()
+        self._closed = Event()
+        self._reconnect = ReconnectScheduler()
 
-        Thread.__init__(self)
+        Thread.__init__(self, name='live')
         self.daemon = True
         self.start()
 
 
-    def on_update(self, callback):
-        self._callbacks.append(callback)
+    def on_update(self, callback, batch=False, raw=False):
+        self._callbacks.append((callback, batch, raw))
+
+
+    def set_cursor(self, cursor):
+        self._cursor = cursor
+
+
+    def set_ready(self):
+        self._ready.set()
+
+
+    def stats(self):
+        return self._reconnect.stats()
 
 
     def close(self):
-        pass
+        self._closed.set()
+        self._ready.set()
+        connection = self._connection
+        if connection:
+            connection.abort()
 
 
     def run(self):
-        # XXX: Wait for the command line to initialize
-        time.sleep(1.0)
+        self._ready.wait()
+        if self._closed.is_set():
+            return
 
         url = '/api/live.json'
         headers = {}
-        timeout = 10
+        if self._cursor:
+            headers['cursor'] = self._cursor
 
-        with closing(self._connection):
-            while True:
+        # Long polling keeps a connection from the pool for itself
+        with self._pool.connection() as connection:
+            self._connection = connection
+            while not self._closed.is_set():
+                # Messages of a big catch-up response are delivered in
+                # batches as they are received
                 try:
-                    event = self._connection.request('GET', url, headers)
+                    for messages in connection.request_items('GET', url,
+                                                             'messages',
+                                                             headers):
+                        headers['cursor'] = messages[-1].get('_id', 'null')
+                        deliver(self._callbacks, messages)
                 except NetworkError, e:
-                    error('{msg}, waiting for {n} secs...'.format(
-                              msg=unicode(e),
-                              n=timeout))
-                    time.sleep(timeout)
+                    # `close` breaks the request in progress
+                    if self._closed.is_set():
+                        return
+                    delay = self._reconnect.failure(e)
+                    log_failure(e, delay)
+                    self._closed.wait(delay)
                     continue
+                self._reconnect.success()
+
+
+def log_failure(e, delay):
+    if delay:
+        live_log.error('{0}, reconnecting in {1:.1f} secs...', unicode(e),
+                       delay, kind=e.kind)
+    else:
+        live_log.debug('{0}, reconnecting...', unicode(e), kind=e.kind)
+
+
+def deliver(callbacks, messages):
+    '''Pass live messages to callbacks, reporting errors of each callback.
+
+    Batch callbacks get all the messages at once, other callbacks are called
+    for each message. Messages are converted to `Message` objects except for
+    raw callbacks.
+    '''
+    metrics.mark('live.events', len(messages))
+    models = [Message.from_json(m) for m in messages]
+    for f, batch, raw in callbacks:
+        items = messages if raw else models
+        started = time.time()
+        try:
+            if batch:
+                f(items)
+            else:
+                for m in items:
+                    f(m)
+        except Exception, e:
+            live_log.error(unicode(e), exc=e)
+        metrics.observe('callback ' + callback_name(f),
+                        time.time() - started)
+
 
-                messages = event.get('messages', [])
-                if messages:
-                    headers['cursor'] = messages[-1].get('_id', 'null')
-                for f in self._callbacks:
-                    try:
-                        for m in messages:
-                            f(m)
-                    except Exception, e:
-                        error(unicode(e), exc=e)
+def callback_name(f):
+    '''Return the name of a callback, e.g. `Console.handle_live_batch`.'''
+    owner = getattr(f, '__self__', None)
+    if owner is None:
+        return getattr(f, '__name__', repr(f))
+    return '{0}.{1}'.format(type(owner).__name__, f.__name__)
 
 
 def authheader(login, password):
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import json
+import errno
+import socket
+from itertools import count
+from threading import Thread, Lock, Event
+from Queue import Queue, Full
+
+from convoread import models
+from convoread.config import config
+from convoread.convore import NetworkError, deliver
+from convoread.metrics import metrics
+from convoread.utils import Logger, data_dir
+
+
+log = Logger('daemon')
+
+# Methods of `Convore` that clients may call
+METHODS = [
+    'get_username', 'has_cached_data', 'get_groups', 'get_topics',
+    'get_group', 'get_topic', 'get_group_topics', 'get_group_by_slug',
+    'list_groups',
+    'list_group_topics', 'list_unread_topics', 'get_topic_messages',
+    'get_recent_users', 'send_message', 'mark_all_read', 'mark_group_read',
+    'set_active_topic', 'search', 'get_stats', 'get_live_stats',
+]
+
+
+def socket_path():
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        path = os.path.join(base, 'convoread')
+        if not os.path.isdir(path):
+            os.makedirs(path, 0700)
+    else:
+        path = data_dir()
+    return os.path.join(path, 'daemon.sock')
+
+
+class Daemon(object):
+    '''Serves one `Convore` to console clients over a Unix socket.
+
+    The protocol is JSON Lines. A client sends `{"id": N, "method": NAME,
+    "args": [...]}` and gets `{"id": N, "result": ...}` or `{"id": N,
+    "error": MESSAGE, "kind": KIND, "status": STATUS}`. Requests are handled
+    concurrently. Live events are pushed to all clients as `{"live":
+    [...]}`. Clients that don't read their events fast enough are
+    disconnected.
+    '''
+    def __init__(self, convore, path=None):
+        self.convore = convore
+        self.path = path or socket_path()
+        self._clients = set()
+        self._lock = Lock()
+        self._closed = Event()
+        self._sock = _listen(self.path)
+        convore.on_live_batch(self._broadcast, raw=True)
+
+
+    def serve_forever(self):
+        self.convore.set_ready()
+        log.info('listening on "{0}"', self.path)
+        while not self._closed.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except socket.error, e:
+                if self._closed.is_set():
+                    return
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+            client = _Client(sock, self._handle, self._remove)
+            with self._lock:
+                self._clients.add(client)
+            client.start()
+
+
+    def close(self):
+        self._closed.set()
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
+
+
+    def _handle(self, client, request):
+        id = request.get('id')
+        method = request.get('method')
+        if method not in METHODS:
+            client.send({'id': id, 'error': 'unknown method "{0}"'.format(
+                                                method)})
+            return
+        try:
+            result = getattr(self.convore, method)(*request.get('args', []))
+        except NetworkError, e:
+            client.send({'id': id, 'error': unicode(e), 'kind': e.kind,
+                         'status': e.status})
+        except Exception, e:
+            log.error('{0} failed: {1}', method, unicode(e), exc=e)
+            client.send({'id': id, 'error': unicode(e)})
+        else:
+            client.send({'id': id, 'result': result})
+
+
+    def _broadcast(self, events):
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.send({'live': events})
+
+
+    def _remove(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+
+class _Client(object):
+    def __init__(self, sock, handle, remove):
+        self._sock = sock
+        self._handle = handle
+        self._remove = remove
+        self._queue = Queue(config['DAEMON_CLIENT_QUEUE_SIZE'])
+        self._closed = False
+
+
+    def start(self):
+        for target in [self._read, self._write]:
+            thread = Thread(target=target, name='client')
+            thread.daemon = True
+            thread.start()
+
+
+    def send(self, message):
+        if self._closed:
+            return
+        try:
+            self._queue.put_nowait(encode(message))
+        except Full:
+            log.warning('client is too slow, disconnecting')
+            self.close()
+
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._remove(self)
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        try:
+            self._queue.put_nowait(None)
+        except Full:
+            pass
+
+
+    def _read(self):
+        try:
+            for line in self._sock.makefile('rb'):
+                request = json.loads(line.decode('UTF-8'),
+                                     object_hook=_decode_object)
+                thread = Thread(target=self._handle, args=(self, request))
+                thread.daemon = True
+                thread.start()
+        except (socket.error, ValueError), e:
+            log.debug('client error: {0}', e)
+        self.close()
+
+
+    def _write(self):
+        while True:
+            data = self._queue.get()
+            if data is None or self._closed:
+                return
+            try:
+                self._sock.sendall(data)
+            except socket.error, e:
+                log.debug('client error: {0}', e)
+                self.close()
+                return
+
+
+class RemoteConvore(object):
+    '''Client of a `Daemon` with the same interface as `Convore`.
+
+    Live events are passed to callbacks as in `Convore` on a dispatch
+    thread, so that callbacks may call the daemon while responses are being
+    received.
+    '''
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+        self._ids = count()
+        self._pending = {}
+        self._callbacks = []
+        self._stats_callbacks = []
+        self._lock = Lock()
+        self._username = None
+        self._closed = False
+        self._events = Queue()
+        for target in [self._read, self._dispatch]:
+            thread = Thread(target=target, name='remote')
+            thread.daemon = True
+            thread.start()
+
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            raise AttributeError(name)
+
+        def call(*args):
+            return self._call(name, *args)
+        call.__name__ = str(name)
+        return call
+
+
+    def get_username(self):
+        if self._username is None:
+            self._username = self._call('get_username')
+        return self._username
+
+
+    def get_stats(self):
+        stats = self._call('get_stats')
+        # Live callbacks of attached clients run here, not in the daemon
+        stats['client_metrics'] = metrics.snapshot()
+        for name, callback in self._stats_callbacks:
+            stats[name] = callback()
+        return stats
+
+
+    def on_stats(self, name, callback):
+        self._stats_callbacks.append((name, callback))
+
+
+    def on_live_update(self, callback):
+        self._callbacks.append((callback, False, False))
+
+
+    def on_live_batch(self, callback, raw=False):
+        self._callbacks.append((callback, True, raw))
+
+
+    def set_ready(self):
+        pass
+
+
+    def close(self):
+        self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+
+
+    def _call(self, method, *args):
+        waiter = [Event(), None]
+        with self._lock:
+            id = next(self._ids)
+            self._pending[id] = waiter
+            try:
+                self._sock.sendall(encode({'id': id, 'method': method,
+                                           'args': list(args)}))
+            except socket.error, e:
+                del self._pending[id]
+                raise NetworkError('daemon connection error: {0}'.format(
+                        e.args[-1]), 'socket')
+        waiter[0].wait()
+        response = waiter[1]
+        if 'error' in response:
+            raise NetworkError(response['error'],
+                               response.get('kind') or 'protocol',
+                               response.get('status'))
+        return response.get('result')
+
+
+    def _read(self):
+        try:
+            for line in self._sock.makefile('rb'):
+                message = json.loads(line.decode('UTF-8'),
+                                     object_hook=_decode_object)
+                if 'live' in message:
+                    self._events.put(message['live'])
+                    continue
+                with self._lock:
+                    waiter = self._pending.pop(message.get('id'), None)
+                if waiter:
+                    waiter[1] = message
+                    waiter[0].set()
+        except (socket.error, ValueError), e:
+            log.debug('daemon connection error: {0}', e)
+        if not self._closed:
+            log.error('disconnected from the daemon')
+        self._events.put(None)
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for waiter in pending:
+            waiter[1] = {'error': 'disconnected from the daemon',
+                         'kind': 'reset'}
+            waiter[0].set()
+
+
+    def _dispatch(self):
+        while True:
+            events = self._events.get()
+            if events is None:
+                return
+            deliver(self._callbacks, events)
+
+
+def encode(message):
+    '''Encode a protocol message as a JSON line.
+
+    Models and dicts with non-string keys are tagged, so that `decode`
+    restores them.
+    '''
+    return json.dumps(_encode_value(message)) + b'\n'
+
+
+def _encode_value(value):
+    if isinstance(value, models.Model):
+        result = dict((name, _encode_value(v)) for name, v in value.items())
+        result['__model__'] = type(value).__name__
+        return result
+    if isinstance(value, dict):
+        if all(isinstance(key, basestring) for key in value):
+            return dict((key, _encode_value(v)) for key, v in value.items())
+        return {'__items__': [[_encode_value(k), _encode_value(v)]
+                              for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(v) for v in value]
+    return value
+
+
+def _decode_object(obj):
+    name = obj.pop('__model__', None)
+    if name in _MODELS:
+        return _MODELS[name].from_json(obj)
+    if '__items__' in obj:
+        return dict((key, value) for key, value in obj['__items__'])
+    return obj
+
+
+_MODELS = dict((cls.__name__, cls) for cls in [models.Group, models.Topic,
+                                               models.Message, models.User])
+
+
+def _listen(path):
+    '''Return a socket listening on `path`, removing a stale socket file.'''
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.unlink(path)
+        else:
+            probe.close()
+            raise RuntimeError('daemon is already running on "{0}"'.format(
+                    path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(16)
+    return sock
@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''A minimal single-threaded event loop with generator-based coroutines.
+
+A coroutine is a generator that yields `Future` objects and is resumed with
+their results. It returns a value by raising `Return`.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import os
+import errno
+import heapq
+import select
+import socket
+import ssl
+import sys
+import time
+from threading import Event, Lock, current_thread
+
+from convoread.utils import Logger
+
+
+log = Logger('eventloop')
+
+
+class Return(Exception):
+    '''Raised by a coroutine to return a value.'''
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    '''The result of an operation that may not have completed yet.
+
+    Callbacks are called on the thread that completes the future. Other
+    threads may block until it is done using `wait`.
+    '''
+    def __init__(self):
+        self._done = Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = Lock()
+
+
+    def done(self):
+        return self._done.is_set()
+
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+
+    def result(self):
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.result()
+
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class EventLoop(object):
+    '''A select-based event loop.
+
+    All methods except `call_soon_threadsafe` and `run_coroutine_threadsafe`
+    must be called from the loop thread.
+    '''
+    def __init__(self):
+        self._ready = []
+        self._timers = []
+        self._readers = {}
+        self._writers = {}
+        self._running = False
+        self._thread = None
+        self._lock = Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._readers[self._wakeup_r] = self._drain_wakeup
+
+
+    def is_loop_thread(self):
+        return current_thread() is self._thread
+
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self._lock:
+            self._ready.append((callback, args))
+        os.write(self._wakeup_w, b'x')
+
+
+    def call_later(self, delay, callback, *args):
+        heapq.heappush(self._timers, (time.time() + delay, callback, args))
+
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+
+
+    def create_task(self, coroutine):
+        '''Schedule a coroutine and return a future of its result.'''
+        future = Future()
+        self.call_soon(_step, self, coroutine, future, None, None)
+        return future
+
+
+    def run_coroutine_threadsafe(self, coroutine):
+        future = Future()
+        self.call_soon_threadsafe(_step, self, coroutine, future, None, None)
+        return future
+
+
+    def stop(self):
+        self.call_soon_threadsafe(self._stop)
+
+
+    def run_forever(self):
+        self._thread = current_thread()
+        self._running = True
+        while self._running:
+            self._run_once()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+
+    def _stop(self):
+        self._running = False
+
+
+    def _run_once(self):
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(self._timers[0][0] - time.time(), 0)
+        try:
+            readable, writable, _ = select.select(list(self._readers),
+                                                  list(self._writers), [],
+                                                  timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = writable = []
+
+        for fd in readable:
+            callback = self._readers.get(fd)
+            if callback:
+                self._ready.append((callback, ()))
+        for fd in writable:
+            callback = self._writers.get(fd)
+            if callback:
+                self._ready.append((callback, ()))
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, callback, args = heapq.heappop(self._timers)
+            self._ready.append((callback, args))
+
+        with self._lock:
+            ready, self._ready = self._ready, []
+        for callback, args in ready:
+            try:
+                callback(*args)
+            except Exception, e:
+                log.error(unicode(e), exc=e)
+
+
+    def _drain_wakeup(self):
+        os.read(self._wakeup_r, 4096)
+
+
+def _step(loop, coroutine, future, value, exc_info):
+    try:
+        if exc_info:
+            waiting = coroutine.throw(*exc_info)
+        else:
+            waiting = coroutine.send(value)
+    except StopIteration:
+        future.set_result(None)
+        return
+    except Return, e:
+        future.set_result(e.value)
+        return
+    except Exception:
+        future.set_exception(sys.exc_info())
+        return
+
+    def resume(f):
+        try:
+            result = f.result()
+        except Exception:
+            loop.call_soon(_step, loop, coroutine, future, None,
+                           sys.exc_info())
+        else:
+            loop.call_soon(_step, loop, coroutine, future, result, None)
+
+    waiting.add_done_callback(resume)
+
+
+def sleep(loop, delay):
+    future = Future()
+    loop.call_later(delay, future.set_result, None)
+    return future
+
+
+def gather(loop, coroutines):
+    '''Run coroutines concurrently, return a future of their futures.'''
+    futures = [loop.create_task(c) for c in coroutines]
+    result = Future()
+    pending = [len(futures)]
+
+    def done(f):
+        pending[0] -= 1
+        if pending[0] == 0:
+            result.set_result(futures)
+
+    if not futures:
+        result.set_result(futures)
+    for f in futures:
+        f.add_done_callback(done)
+    return result
+
+
+def _wait_fd(loop, fd, writable, timeout=None):
+    future = Future()
+    add, remove = ((loop.add_writer, loop.remove_writer) if writable
+                   else (loop.add_reader, loop.remove_reader))
+
+    def ready():
+        if future.done():
+            return
+        remove(fd)
+        future.set_result(None)
+
+    def expire():
+        if future.done():
+            return
+        remove(fd)
+        try:
+            raise socket.timeout('timed out')
+        except socket.timeout:
+            future.set_exception(sys.exc_info())
+
+    add(fd, ready)
+    if timeout is not None:
+        loop.call_later(timeout, expire)
+    return future
+
+
+class AsyncSocket(object):
+    '''A non-blocking TCP or TLS client socket driven by an event loop.'''
+    def __init__(self, loop, host, port, secure=True, timeout=60):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.timeout = timeout
+        self.sock = None
+
+
+    def connect(self):
+        # Name resolution is blocking, but it is fast compared to connecting
+        family, type, proto, _, address = socket.getaddrinfo(
+                self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, type, proto)
+        sock.setblocking(False)
+        self.sock = sock
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+        yield self._wait(True, sock)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        if self.secure:
+            # The same certificate and host name checks as in httplib
+            context = ssl._create_default_https_context()
+            self.sock = context.wrap_socket(sock, server_hostname=self.host,
+                                            do_handshake_on_connect=False)
+            while True:
+                try:
+                    self.sock.do_handshake()
+                    break
+                except ssl.SSLError, e:
+                    yield self._wait_ssl(e)
+                except ssl.CertificateError, e:
+                    raise ssl.SSLError(ssl.SSL_ERROR_SSL,
+                                       'certificate error: {0}'.format(e))
+
+
+    def sendall(self, data):
+        while data:
+            try:
+                sent = self.sock.send(data)
+                data = data[sent:]
+            except ssl.SSLError, e:
+                yield self._wait_ssl(e)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                yield self._wait(True)
+
+
+    def recv(self, size=65536):
+        '''Return the next chunk of data or an empty string at EOF.'''
+        while True:
+            try:
+                raise Return(self.sock.recv(size))
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_EOF:
+                    raise Return(b'')
+                yield self._wait_ssl(e)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                yield self._wait(False)
+
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+    def _wait(self, writable, sock=None):
+        '''Wait until the socket is ready, for at most `timeout` secs.'''
+        sock = sock or self.sock
+        return _wait_fd(self.loop, sock.fileno(), writable, self.timeout)
+
+
+    def _wait_ssl(self, e):
+        if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+            return self._wait(False)
+        elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+            return self._wait(True)
+        raise e
+
+
+def fetch(loop, host, method, url, body=None, headers=None, port=443,
+          secure=True):
+    '''Make an HTTP/1.1 request, return `(status, reason, headers, body)`.'''
+    sock = AsyncSocket(loop, host, port, secure)
+    try:
+        yield loop.create_task(sock.connect())
+        if port != (443 if secure else 80):
+            host = '{0}:{1}'.format(host, port)
+        lines = ['{0} {1} HTTP/1.1'.format(method, url),
+                 'Host: {0}'.format(host),
+                 'Connection: close']
+        if body is not None:
+            lines.append('Content-Length: {0}'.format(len(body)))
+            lines.append('Content-Type: application/x-www-form-urlencoded')
+        for name, value in (headers or {}).items():
+            lines.append('{0}: {1}'.format(name, value))
+        request = '\r\n'.join(lines).encode('ascii') + b'\r\n\r\n'
+        yield loop.create_task(sock.sendall(request + (body or b'')))
+
+        parser = _ResponseParser()
+        while True:
+            chunk = yield loop.create_task(sock.recv())
+            if not chunk:
+                break
+            response = parser.feed(chunk)
+            if response:
+                raise Return(response)
+    finally:
+        sock.close()
+    response = parser.finish()
+    if not response:
+        raise socket.error(errno.ECONNRESET, 'incomplete HTTP response')
+    raise Return(response)
+
+
+# States of the response parser
+_LENGTH, _UNTIL_EOF, _CHUNK_SIZE, _CHUNK_DATA, _CHUNK_END, _TRAILER = range(6)
+
+
+class _ResponseParser(object):
+    '''Incremental parser of an HTTP response received in chunks.
+
+    The head is parsed once, body data is collected in a list as it arrives
+    and only a partial line of the chunked framing is kept between chunks,
+    so a body of any size is parsed in linear time.
+    '''
+    def __init__(self):
+        self._head = b''
+        self._buf = b''
+        self._body = []
+        self._response = None
+        self._state = None
+        self._remaining = 0
+
+
+    def feed(self, data):
+        '''Return `(status, reason, headers, body)` if the response is
+        complete, otherwise `None`.'''
+        if self._response is None:
+            self._head += data
+            head, sep, data = self._head.partition(b'\r\n\r\n')
+            if not sep:
+                return None
+            self._head = None
+            self._parse_head(head)
+        if self._state == _UNTIL_EOF:
+            self._body.append(data)
+            return None
+        if self._state == _LENGTH:
+            data = data[:self._remaining]
+            self._body.append(data)
+            self._remaining -= len(data)
+            return self._result() if self._remaining == 0 else None
+        return self._feed_chunked(self._buf + data)
+
+
+    def finish(self):
+        '''Return the response at EOF or `None` if it is incomplete.'''
+        if self._state == _UNTIL_EOF:
+            return self._result()
+        return None
+
+
+    def _parse_head(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            _, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise socket.error(errno.ECONNRESET, 'bad HTTP status line')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        self._response = status, reason, headers
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            self._state = _CHUNK_SIZE
+        elif 'content-length' in headers:
+            self._state = _LENGTH
+            self._remaining = int(headers['content-length'])
+        else:
+            self._state = _UNTIL_EOF
+
+
+    def _feed_chunked(self, data):
+        pos = 0
+        while True:
+            if self._state == _CHUNK_DATA:
+                chunk = data[pos:pos + self._remaining]
+                self._body.append(chunk)
+                pos += len(chunk)
+                self._remaining -= len(chunk)
+                if self._remaining:
+                    break
+                self._state = _CHUNK_END
+            elif self._state == _CHUNK_END:
+                if len(data) - pos < 2:
+                    break
+                pos += 2
+                self._state = _CHUNK_SIZE
+            else:
+                end = data.find(b'\r\n', pos)
+                if end < 0:
+                    break
+                line = data[pos:end]
+                pos = end + 2
+                if self._state == _TRAILER:
+                    if not line:
+                        return self._result()
+                    continue
+                try:
+                    size = int(line.split(b';')[0], 16)
+                except ValueError:
+                    raise socket.error(errno.ECONNRESET, 'bad HTTP chunk')
+                if size:
+                    self._state = _CHUNK_DATA
+                    self._remaining = size
+                else:
+                    self._state = _TRAILER
+        self._buf = data[pos:]
+        return None
+
+
+    def _result(self):
+        status, reason, headers = self._response
+        return status, reason, headers, b''.join(self._body)
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''A local stand-in for the Convore API server used by benchmarks.'''
+
+from __future__ import unicode_literals, print_function
+
+import json
+import re
+import socket
+import sys
+import time
+from hashlib import md5
+from threading import Thread, Condition
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+LIVE_TIMEOUT = 5.0
+
+# Messages of the client's own account don't count as unread
+ACCOUNT = 'bench'
+
+
+class FakeConvore(object):
+    '''Fake Convore API with generated groups, topics and messages.
+
+    `latency` is added to every response in seconds, `message_size` is the
+    length of message texts and `rate` is the number of live messages per
+    second.
+    '''
+    def __init__(self, groups=20, topics=10, messages=30, message_size=100,
+                 latency=0.0, rate=0.0, port=0):
+        self.latency = latency
+        self.rate = rate
+        self.message_size = message_size
+        self.requests = {}
+        self._next_id = 1
+        self._live = []
+        self._live_cond = Condition()
+        self._running = False
+
+        self.groups = {}
+        self.topics = {}
+        self.messages = {}
+        for g in range(1, groups + 1):
+            self.groups[g] = {
+                'id': g,
+                'slug': 'group{0}'.format(g),
+                'name': 'Group {0}'.format(g),
+                'unread': sum(t % 3 for t in range(topics)),
+                'date_latest_message': 0,
+            }
+            for t in range(topics):
+                topic_id = g * 1000 + t
+                self.topics[topic_id] = {
+                    'id': topic_id,
+                    'name': 'Topic {0}'.format(topic_id),
+                    'url': '/group{0}/topic{1}/'.format(g, topic_id),
+                    'unread': t % 3,
+                    'date_latest_message': 0,
+                }
+                self.messages[topic_id] = [
+                        self._message(g, topic_id, 'user{0}'.format(i % 7))
+                        for i in range(messages)]
+
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.fake = self
+
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self._server.server_address)
+
+
+    def start(self):
+        self._running = True
+        for target in [self._server.serve_forever, self._generate]:
+            thread = Thread(target=target, name='fakeserver')
+            thread.daemon = True
+            thread.start()
+
+
+    def stop(self):
+        self._running = False
+        self._server.shutdown()
+        self._server.server_close()
+        with self._live_cond:
+            self._live_cond.notify_all()
+        self._server.close_requests()
+
+
+    def post(self, topic_id, username, text=None):
+        '''Add a new message to a topic and to the live stream.'''
+        live = self.live_message(topic_id, username, text)
+        with self._live_cond:
+            self._live.append(live)
+            del self._live[:-10000]
+            self._live_cond.notify_all()
+        return live
+
+
+    def live_message(self, topic_id, username, text=None):
+        '''Add a new message to a topic, return it as a live message.'''
+        topic = self.topics[topic_id]
+        group_id = topic_id // 1000
+        message = self._message(group_id, topic_id, username, text)
+        self.messages[topic_id].append(message)
+        group = self.groups[group_id]
+        for item in [topic, group]:
+            item['date_latest_message'] = message['date_created']
+            if username != ACCOUNT:
+                item['unread'] += 1
+        return dict(message, kind='message', group=group_id,
+                    _id=str(message['id']), _ts=message['date_created'],
+                    topic={'id': topic_id, 'name': topic['name'],
+                           'url': topic['url']})
+
+
+    def live_after(self, cursor, timeout=LIVE_TIMEOUT):
+        '''Return live messages after `cursor`, waiting for new ones.'''
+        deadline = time.time() + timeout
+        with self._live_cond:
+            if cursor in (None, 'null'):
+                cursor = self._live[-1]['_id'] if self._live else '0'
+            while self._running:
+                messages = [m for m in self._live
+                            if int(m['_id']) > int(cursor)]
+                remaining = deadline - time.time()
+                if messages or remaining <= 0:
+                    return messages
+                self._live_cond.wait(remaining)
+        return []
+
+
+    def _message(self, group_id, topic_id, username, text=None):
+        id = self._next_id
+        self._next_id += 1
+        if text is None:
+            text = ('message {0} '.format(id) * self.message_size)
+            text = text[:self.message_size]
+        return {
+            'id': id,
+            'message': text,
+            'date_created': time.time(),
+            'user': {
+                'id': hash(username) % 100000,
+                'username': username,
+                'img': '',
+            },
+        }
+
+
+    def _generate(self):
+        n = 0
+        topic_ids = sorted(self.topics)
+        while self._running:
+            if self.rate <= 0:
+                time.sleep(0.1)
+                continue
+            self.post(topic_ids[n % len(topic_ids)],
+                      'user{0}'.format(n % 7))
+            n += 1
+            time.sleep(1.0 / self.rate)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.requests = set()
+
+
+    def close_requests(self, timeout=1.0):
+        '''Close the connections of all clients and wait for handlers.'''
+        for request in list(self.requests):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        deadline = time.time() + timeout
+        while self.requests and time.time() < deadline:
+            time.sleep(0.01)
+
+
+    def handle_error(self, request, client_address):
+        # Clients drop long polling requests when they exit
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', r'^/api/groups\.json$', 'groups'),
+        ('GET', r'^/api/groups/(\d+)/topics\.json$', 'group_topics'),
+        ('GET', r'^/api/topics/(\d+)/messages\.json$', 'topic_messages'),
+        ('GET', r'^/api/live\.json$', 'live'),
+        ('POST', r'^/api/topics/(\d+)/messages/create\.json$', 'create'),
+        ('POST', r'^/api/account/mark_read\.json$', 'mark_all_read'),
+        ('POST', r'^/api/groups/(\d+)/mark_read\.json$', 'mark_group_read'),
+        ('POST', r'^/api/topics/(\d+)/mark_read\.json$', 'mark_topic_read'),
+    ]
+
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.requests.add(self.request)
+
+
+    def finish(self):
+        self.server.requests.discard(self.request)
+        BaseHTTPRequestHandler.finish(self)
+
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _dispatch(self, method):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        for route_method, pattern, name in self.routes:
+            match = re.match(pattern, url.path)
+            if route_method == method and match:
+                break
+        else:
+            self._respond(404, {'error': 'not found'})
+            return
+        fake.requests[name] = fake.requests.get(name, 0) + 1
+        if fake.latency:
+            time.sleep(fake.latency)
+        args = [int(x) for x in match.groups()]
+        params = parse_qs(url.query)
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            params.update(parse_qs(self.rfile.read(length)))
+        try:
+            result = getattr(self, '_' + name)(fake, params, *args)
+        except KeyError:
+            self._respond(404, {'error': 'not found'})
+            return
+        self._respond(200, result)
+
+
+    def _groups(self, fake, params):
+        return {'groups': list(fake.groups.values())}
+
+
+    def _group_topics(self, fake, params, group_id):
+        fake.groups[group_id]
+        return {'topics': [t for id, t in fake.topics.items()
+                           if id // 1000 == group_id]}
+
+
+    def _topic_messages(self, fake, params, topic_id):
+        # Reading messages marks the topic as read
+        self._mark_topic_read(fake, params, topic_id)
+        return {'messages': fake.messages[topic_id][-30:]}
+
+
+    def _live(self, fake, params):
+        cursor = params.get('cursor', [None])[0]
+        return {'messages': fake.live_after(cursor)}
+
+
+    def _create(self, fake, params, topic_id):
+        text = params.get('message', [''])[0].decode('UTF-8')
+        return {'message': fake.post(topic_id, ACCOUNT, text)}
+
+
+    def _mark_all_read(self, fake, params):
+        for item in list(fake.groups.values()) + list(fake.topics.values()):
+            item['unread'] = 0
+        return {}
+
+
+    def _mark_group_read(self, fake, params, group_id):
+        fake.groups[group_id]['unread'] = 0
+        for id, topic in fake.topics.items():
+            if id // 1000 == group_id:
+                topic['unread'] = 0
+        return {}
+
+
+    def _mark_topic_read(self, fake, params, topic_id):
+        topic = fake.topics[topic_id]
+        group = fake.groups[topic_id // 1000]
+        group['unread'] = max(group['unread'] - topic['unread'], 0)
+        topic['unread'] = 0
+        return {}
+
+
+    def _respond(self, status, result):
+        body = json.dumps(result).encode('UTF-8')
+        etag = '"{0}"'.format(md5(body).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''Incremental decoding of JSON responses.
+
+API responses with many messages or topics are objects with one big array
+like `{"messages": [...]}`. Decoding them with `json.loads` keeps the raw
+bytes, the decoded text and the whole object tree in memory at once. The
+decoder here takes the body in chunks as it is received and decodes the
+items of the array one by one, so only the current chunk and the item being
+decoded are kept.
+'''
+
+from __future__ import unicode_literals, print_function
+
+import re
+import json
+
+
+_WHITESPACE = re.compile(br'[ \t\n\r]*')
+
+# States of the decoder, named by what is expected next
+(_OBJECT, _FIRST_KEY, _KEY, _COLON, _VALUE, _NEXT_FIELD, _FIRST_ITEM, _ITEM,
+ _NEXT_ITEM, _END) = range(10)
+
+
+class ItemDecoder(object):
+    '''Incremental decoder of the items of the array `key` of a JSON object.
+
+    `feed` returns the items completed by a chunk of data. Other fields of
+    the object are decoded as a whole into `fields`. Each value is decoded by
+    the C scanner of `json` once it has been received completely.
+    '''
+    def __init__(self, key):
+        self.key = key
+        self.fields = {}
+        self._decoder = json.JSONDecoder()
+        self._buf = b''
+        self._pos = 0
+        self._state = _OBJECT
+        self._field = None
+        self._retry = 0
+
+
+    def feed(self, data):
+        '''Return the list of items completed by `data`.'''
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        items = []
+        while self._step(items, False):
+            pass
+        return items
+
+
+    def close(self):
+        '''Return the remaining items, raise ValueError if data is missing.'''
+        items = []
+        while self._step(items, True):
+            pass
+        if self._state != _END:
+            raise ValueError('incomplete JSON object')
+        return items
+
+
+    def _step(self, items, eof):
+        '''Decode the next token, return False if more data is needed.'''
+        buf = self._buf
+        pos = _WHITESPACE.match(buf, self._pos).end()
+        self._pos = pos
+        if pos == len(buf):
+            return False
+        c = buf[pos:pos + 1]
+        state = self._state
+        if state == _FIRST_ITEM and c != b']':
+            self._state = _ITEM
+            return True
+        if state == _VALUE and self._field == self.key and c == b'[':
+            self._state = _FIRST_ITEM
+            self._pos = pos + 1
+            return True
+        if (state in (_VALUE, _ITEM) or
+                state in (_FIRST_KEY, _KEY) and c == b'"'):
+            value = self._decode(pos, eof)
+            if value is _INCOMPLETE:
+                return False
+            if state == _VALUE:
+                self.fields[self._field] = value
+                self._state = _NEXT_FIELD
+            elif state == _ITEM:
+                items.append(value)
+                self._state = _NEXT_ITEM
+            else:
+                self._field = value
+                self._state = _COLON
+            return True
+        try:
+            self._state = _TRANSITIONS[state][c]
+        except KeyError:
+            raise ValueError('unexpected {0!r} in JSON object'.format(c))
+        self._pos = pos + 1
+        return True
+
+
+    def _decode(self, pos, eof):
+        '''Decode the value at `pos` or return `_INCOMPLETE`.'''
+        available = len(self._buf) - pos
+        # A value that failed to decode is retried once its data has
+        # doubled, so a value spanning many chunks is not decoded each time
+        if available < self._retry and not eof:
+            return _INCOMPLETE
+        try:
+            value, end = self._decoder.raw_decode(self._buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            self._retry = 2 * available
+            return _INCOMPLETE
+        if not eof and self._buf[end:end + 1] not in _DELIMITERS:
+            # A number like `1.` may continue in the next chunk, so a value
+            # is complete only when followed by a delimiter
+            self._retry = available + 1
+            return _INCOMPLETE
+        self._retry = 0
+        self._pos = end
+        return value
+
+
+_INCOMPLETE = object()
+
+_DELIMITERS = frozenset(b', \t\n\r]}:'[i:i + 1] for i in range(8))
+
+_TRANSITIONS = {
+    _OBJECT: {b'{': _FIRST_KEY},
+    _FIRST_KEY: {b'}': _END},
+    _COLON: {b':': _VALUE},
+    _NEXT_FIELD: {b',': _KEY, b'}': _END},
+    _FIRST_ITEM: {b']': _NEXT_FIELD},
+    _NEXT_ITEM: {b',': _ITEM, b']': _NEXT_FIELD},
+}
+
+
+def iter_batches(chunks, key):
+    '''Yield non-empty lists of the items of the array `key` in `chunks`.'''
+    decoder = ItemDecoder(key)
+    for chunk in chunks:
+        items = decoder.feed(chunk)
+        if items:
+            yield items
+    items = decoder.close()
+    if items:
+        yield items
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import unicode_literals, print_function
+
+import heapq
+from itertools import count
+from threading import Lock
+
+
+class MessageStore(object):
+    '''Recent messages of topics, kept up to date by the live stream.
+
+    A topic is current if its messages were fetched from the server during
+    this session. New messages of current topics arrive via the live stream,
+    so they don't have to be fetched again. Messages loaded from the disk
+    cache may have gaps and are not current until they are fetched. Live
+    messages of a topic with nothing stored are kept between `start_fetch`
+    and `merge`, so they aren't lost while its first fetch is in flight.
+
+    At most `limit` messages are kept per topic. If there are more than
+    `max_topics` topics or `max_total` messages, the messages of the least
+    recently used topics are dropped. Reading a topic and live messages in it
+    count as a use.
+    '''
+    def __init__(self, limit, messages=None, max_total=None, max_topics=None):
+        self._limit = limit
+        self._max_total = max_total
+        self._max_topics = max_topics
+        self._topics = {}
+        self._current = set()
+        self._fetching = {}
+        self._total = 0
+        self._clock = count()
+        self._used = {}
+        self._lru = []
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Topics with older messages are dropped first
+        cached = sorted((messages or {}).items(),
+                        key=lambda item: _last_time(item[1]))
+        with self._lock:
+            for topic_id, topic_messages in cached:
+                self._store(topic_id, list(topic_messages)[-limit:])
+            self._evict()
+
+
+    def get(self, topic_id):
+        '''Return the messages of a current topic or `None`.'''
+        with self._lock:
+            if topic_id not in self._current:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(topic_id)
+            return list(self._topics[topic_id])
+
+
+    def start_fetch(self, topic_id):
+        '''Keep live messages of the topic until its fetch is merged.'''
+        with self._lock:
+            self._fetching.setdefault(topic_id, [])
+
+
+    def cancel_fetch(self, topic_id):
+        with self._lock:
+            self._fetching.pop(topic_id, None)
+
+
+    def merge(self, topic_id, messages):
+        '''Merge fetched messages into the topic and mark it as current.'''
+        with self._lock:
+            known = self._topics.get(topic_id, [])
+            known = known + self._fetching.pop(topic_id, [])
+            ids = set(_message_id(m) for m in messages)
+            merged = [m for m in known if _message_id(m) not in ids]
+            merged.extend(messages)
+            merged.sort(key=_message_time)
+            self._store(topic_id, merged[-self._limit:])
+            self._current.add(topic_id)
+            result = list(self._topics[topic_id])
+            self._evict(keep=topic_id)
+            return result
+
+
+    def add(self, topic_id, message):
+        '''Add a live message to the topic if it has any messages stored.'''
+        with self._lock:
+            messages = self._topics.get(topic_id)
+            if messages is None:
+                if topic_id in self._fetching:
+                    self._fetching[topic_id].append(message)
+                return
+            messages.append(message)
+            self._total += 1
+            if len(messages) > self._limit:
+                self._total -= len(messages) - self._limit
+                del messages[:-self._limit]
+            self._touch(topic_id)
+            self._evict(keep=topic_id)
+
+
+    def invalidate(self):
+        '''Mark all topics as not current, e.g. after missing live updates.'''
+        with self._lock:
+            self._current.clear()
+
+
+    def snapshot(self):
+        with self._lock:
+            return dict((id, list(messages))
+                        for id, messages in self._topics.items())
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                'topics': len(self._topics),
+                'messages': self._total,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+    # The methods below are called with the lock held.
+
+    def _store(self, topic_id, messages):
+        self._total += len(messages) - len(self._topics.get(topic_id, ()))
+        self._topics[topic_id] = messages
+        self._touch(topic_id)
+
+
+    def _touch(self, topic_id):
+        # The LRU heap has an entry for every use. Outdated entries are
+        # skipped on eviction and dropped when the heap gets too large.
+        tick = next(self._clock)
+        self._used[topic_id] = tick
+        heapq.heappush(self._lru, (tick, topic_id))
+        if len(self._lru) > 2 * len(self._used) + 16:
+            self._lru = [(t, id) for id, t in self._used.items()]
+            heapq.heapify(self._lru)
+
+
+    def _evict(self, keep=None):
+        while self._over_limits() and self._lru:
+            tick, topic_id = heapq.heappop(self._lru)
+            if self._used.get(topic_id) != tick:
+                continue
+            if topic_id == keep:
+                # The topic in use is the most recent one, nothing else left
+                heapq.heappush(self._lru, (tick, topic_id))
+                return
+            self._drop(topic_id)
+
+
+    def _over_limits(self):
+        return ((self._max_topics is not None and
+                 len(self._topics) > self._max_topics) or
+                (self._max_total is not None and
+                 self._total > self._max_total))
+
+
+    def _drop(self, topic_id):
+        self._total -= len(self._topics.pop(topic_id))
+        del self._used[topic_id]
+        self._current.discard(topic_id)
+        self.evictions += 1
+
+
+def _message_id(message):
+    return message.get('id', message.get('_id'))
+
+
+def _message_time(message):
+    return message.get('date_created', message.get('_ts'))
+
+
+def _last_time(messages):
+    return _message_time(messages[-1]) if messages else None
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+import re
+import json
+import time
+from bisect import bisect_left
+from threading import Thread, Lock
+
+
+# Upper bounds of histogram buckets in seconds, from 0.1 ms to about 100 s
+BUCKETS = [0.0001 * 2 ** i for i in range(21)]
+
+RATE_WINDOW = 60
+
+
+class Histogram(object):
+    '''Counts of durations in exponentially growing buckets.'''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+    def percentile(self, p):
+        '''Return the upper bound of the bucket of the `p`-th percentile.'''
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.max)
+                return self.max
+        return 0.0
+
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Meter(object):
+    '''Number of events per second over the last `RATE_WINDOW` seconds.'''
+    def __init__(self, now):
+        self._started = now
+        self._second = int(now)
+        self._counts = [0] * RATE_WINDOW
+
+
+    def mark(self, n, now):
+        second = int(now)
+        if second != self._second:
+            self._clear(second)
+        self._counts[second % RATE_WINDOW] += n
+
+
+    def rate(self, now):
+        self._clear(int(now))
+        window = min(max(now - self._started, 1.0), RATE_WINDOW)
+        return sum(self._counts) / window
+
+
+    def _clear(self, second):
+        for s in range(max(self._second + 1, second - RATE_WINDOW + 1),
+                       second + 1):
+            self._counts[s % RATE_WINDOW] = 0
+        self._second = max(self._second, second)
+
+
+class Metrics(object):
+    '''Counters, event rates and duration histograms by name.
+
+    Updates are a few dict operations under a lock, so instrumented code
+    that isn't busy costs next to nothing.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._started = time.time()
+        self._counters = {}
+        self._meters = {}
+        self._histograms = {}
+
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+
+    def mark(self, name, n=1):
+        '''Count `n` events for the counter and the rate of `name`.'''
+        now = time.time()
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+            meter = self._meters.get(name)
+            if meter is None:
+                meter = self._meters[name] = Meter(now)
+            meter.mark(n, now)
+
+
+    def observe(self, name, duration):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(duration)
+
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {
+                'time': now,
+                'uptime': now - self._started,
+                'counters': dict(self._counters),
+                'rates': dict((name, meter.rate(now))
+                              for name, meter in self._meters.items()),
+                'histograms': dict((name, h.snapshot())
+                                   for name, h in self._histograms.items()),
+            }
+
+
+metrics = Metrics()
+
+_ID = re.compile(r'/\d+')
+
+
+def endpoint(method, url):
+    '''Return the name of an API endpoint with ids replaced by `N`.'''
+    path = url.split('?', 1)[0]
+    return '{0} {1}'.format(method, _ID.sub('/N', path))
+
+
+def start_dump(path, interval):
+    '''Write a JSON snapshot of the metrics to `path` every `interval` secs.'''
+    # utils uses metrics, so it can't be imported at the top
+    from convoread.utils import atomic_write, Logger
+
+    log = Logger('metrics')
+
+    def dump():
+        while True:
+            time.sleep(interval)
+            data = json.dumps(metrics.snapshot(), sort_keys=True)
+            try:
+                atomic_write(path, data.encode('UTF-8') + b'\n')
+            except (IOError, OSError), e:
+                log.error('cannot write metrics to "{0}": {1}', path, e)
+
+    thread = Thread(target=dump, name='metrics')
+    thread.daemon = True
+    thread.start()
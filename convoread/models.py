@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+from weakref import WeakValueDictionary
+
+
+_strings = {}
+_shared = WeakValueDictionary()
+
+
+def intern_string(s):
+    '''Return a shared copy of `s`.
+
+    The builtin `intern` accepts only byte strings in Python 2.
+    '''
+    if s is None:
+        return None
+    return _strings.setdefault(s, s)
+
+
+class Model(object):
+    '''Compact object for decoded JSON data of the Convore API.
+
+    Only the fields listed in `fields` are kept, other ones are dropped.
+    Models support the read-only part of the dict interface, so code written
+    for raw JSON dicts keeps working. They are never modified: `replace`
+    returns an updated copy.
+    '''
+    __slots__ = ()
+    fields = ()
+    converters = {}
+
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            self._set(name, value)
+
+
+    @classmethod
+    def from_json(cls, data):
+        if isinstance(data, cls):
+            return data
+        obj = cls.__new__(cls)
+        for name in cls.fields:
+            if name in data:
+                obj._set(name, data[name])
+        return obj
+
+
+    def to_json(self):
+        result = {}
+        for name, value in self.items():
+            if isinstance(value, Model):
+                value = value.to_json()
+            result[name] = value
+        return result
+
+
+    def replace(self, **fields):
+        obj = self.__class__.__new__(self.__class__)
+        for name, value in self.items():
+            setattr(obj, name, value)
+        for name, value in fields.items():
+            obj._set(name, value)
+        return obj
+
+
+    def get(self, name, default=None):
+        if name not in self.fields:
+            return default
+        return getattr(self, name, default)
+
+
+    def __getitem__(self, name):
+        if name in self.fields:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                pass
+        raise KeyError(name)
+
+
+    def __contains__(self, name):
+        return name in self.fields and hasattr(self, name)
+
+
+    def keys(self):
+        return [name for name in self.fields if hasattr(self, name)]
+
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.keys()]
+
+
+    def __repr__(self):
+        return '{0}({1})'.format(
+                self.__class__.__name__,
+                ', '.join('{0}={1!r}'.format(*item) for item in self.items()))
+
+
+    def _set(self, name, value):
+        if name not in self.fields:
+            raise KeyError(name)
+        convert = self.converters.get(name)
+        if convert is not None and value is not None:
+            value = convert(value)
+        setattr(self, name, value)
+
+
+def shared(cls):
+    '''Return a function that converts JSON data to shared `cls` objects.
+
+    Equal objects are created only once while they are referenced, e.g. the
+    author of many messages.
+    '''
+    def convert(data):
+        obj = cls.from_json(data)
+        key = (cls, tuple(obj.items()))
+        return _shared.setdefault(key, obj)
+    return convert
+
+
+class User(Model):
+    __slots__ = ('id', 'username', 'name', 'img', 'url', '__weakref__')
+    fields = ('id', 'username', 'name', 'img', 'url')
+    converters = {'username': intern_string}
+
+
+class Group(Model):
+    __slots__ = fields = ('id', 'slug', 'name', 'url', 'unread',
+                          'date_latest_message')
+    converters = {'slug': intern_string}
+
+
+class Topic(Model):
+    __slots__ = ('id', 'group', 'name', 'url', 'unread',
+                 'date_latest_message', '__weakref__')
+    fields = ('id', 'group', 'name', 'url', 'unread', 'date_latest_message')
+
+
+class Message(Model):
+    __slots__ = fields = ('id', '_id', '_ts', 'kind', 'group', 'topic',
+                          'user', 'message', 'date_created')
+    converters = {
+        'kind': intern_string,
+        'topic': shared(Topic),
+        'user': shared(User),
+    }
@@ -23,51 +23,199 @@
 from __future__ import unicode_literals, print_function
 
 import os
-from tempfile import mkdtemp
-from shutil import rmtree
-from urllib import urlopen
-from hashlib import sha1
-from contextlib import closing
+import time
+from collections import deque
+from threading import Thread
+from Queue import Queue, Full, Empty
 import subprocess
 
 from convoread.config import config
-from convoread.utils import error, debug
+from convoread.utils import Logger, startup_trace
+
+
+log = Logger('notify')
 
 
 class Notifier(object):
+    '''Desktop notifications about new messages.
+
+    Live updates are queued and shown by a worker thread, so the live stream
+    never waits for notifications. Messages arriving within a short period
+    are coalesced by topic and the number of notifications per time window is
+    limited. Messages that don't fit into the queue or the limit are dropped.
+    '''
     def __init__(self, convore):
         self.convore = convore
-        self.convore.on_live_update(self.handle_live_update)
-        if os.path.exists(config['NOTIFY_SEND']):
-            self.enabled = True
-        else:
-            error('desktop notifications are disabled: '
-                  '"{0}" not found'.format(config['NOTIFY_SEND']))
-            self.enabled = False
-        self._tmpdir = mkdtemp()
+        self.convore.on_live_batch(self.handle_live_batch)
+        self.convore.on_stats('notify', self.stats)
+        # The worker thread sets up the rest after startup, messages are
+        # queued meanwhile
+        self.enabled = True
+        self._avatars = None
+        self._queue = Queue(config['NOTIFY_QUEUE_SIZE'])
+        self._shown = deque()
+        self.dropped = 0
+        self.rate_limited = 0
+        self._closed = False
+        self._thread = Thread(target=self._run, name='notify')
+        self._thread.daemon = True
+        self._thread.start()
 
 
     def handle_live_update(self, message):
+        self.handle_live_batch([message])
+
+
+    def handle_live_batch(self, messages):
         if not self.enabled:
             return
 
-        kind = message.get('kind')
-        user = message.get('user', {})
-        username = user.get('username', '(anonymous)')
+        me = self.convore.get_username()
+        messages = [m for m in messages
+                    if m.get('kind') == 'message' and
+                       m.get('user', {}).get('username') != me]
+        if not messages:
+            return
 
-        if kind != 'message' or username == self.convore.get_username():
+        try:
+            self._queue.put_nowait(messages)
+        except Full:
+            self.dropped += len(messages)
+
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'dropped': self.dropped,
+            'rate_limited': self.rate_limited,
+        }
+
+
+    def _run(self):
+        if not self._setup():
             return
+        while not self._closed:
+            messages = self._next_batch()
+            if messages is None:
+                return
+            try:
+                self._notify_batch(messages)
+            except Exception, e:
+                log.error(unicode(e), exc=e)
+
+
+    def _setup(self):
+        if not os.path.exists(config['NOTIFY_SEND']):
+            log.error('desktop notifications are disabled: '
+                      '"{0}" not found', config['NOTIFY_SEND'])
+            self.enabled = False
+            return False
+        # Imported here, urllib2 takes a while to load
+        from convoread.avatars import AvatarCache
+        self._avatars = AvatarCache(self._thumbnail)
+        if self.Image:
+            users = self.convore.get_recent_users()
+            self._avatars.prefetch(u['img'] for u in users if 'img' in u)
+        startup_trace.mark('notifier')
+        return True
 
+
+    def _next_batch(self):
+        '''Wait for messages and collect the ones that follow them shortly.'''
+        messages = self._queue.get()
+        if messages is None:
+            return None
+        messages = list(messages)
+        deadline = time.time() + config['NOTIFY_COALESCE_TIME']
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch = self._queue.get(timeout=timeout)
+            except Empty:
+                break
+            if batch is None:
+                self._queue.put(None)
+                break
+            messages.extend(batch)
+        return messages
+
+
+    def _notify_batch(self, messages):
+        by_topic = {}
+        order = []
+        for message in messages:
+            id = message.get('topic', {}).get('id')
+            if id not in by_topic:
+                by_topic[id] = []
+                order.append(id)
+            by_topic[id].append(message)
+
+        for id in order:
+            if self._closed:
+                return
+            topic_messages = by_topic[id]
+            if not self._allow():
+                self.rate_limited += len(topic_messages)
+                continue
+            if len(topic_messages) == 1:
+                self._notify_message(topic_messages[0])
+            else:
+                self._notify_topic(topic_messages)
+        log.debug('shown notifications for {0} messages', len(messages),
+                  **self.stats())
+
+
+    def _allow(self):
+        now = time.time()
+        window = config['NOTIFY_RATE_WINDOW']
+        while self._shown and self._shown[0] <= now - window:
+            self._shown.popleft()
+        if len(self._shown) >= config['NOTIFY_RATE_LIMIT']:
+            return False
+        self._shown.append(now)
+        return True
+
+
+    def _notify_message(self, message):
+        user = message.get('user', {})
+        username = user.get('username', '(anonymous)')
         img = self.imgpath(user)
-        group = self.convore.get_groups().get(message.get('group'), {})
-        timeout = 15000
+        group = self.convore.get_group(message.get('group')) or {}
         title = '@{user} in {group}'.format(
             group=group.get('slug', '(unkonwn)'),
             user=username)
-        body = '{msg} <a href="https://convore.com{url}">#</a>'.format(
+        body = '{msg} <a href="{base}{url}">#</a>'.format(
                 msg=message.get('message', '(empty)'),
+                base=config['BASE_URL'],
                 url=message.get('topic', {}).get('url', '/'))
+        self._notify_send(title, body, img)
+
 
+    def _notify_topic(self, messages):
+        last = messages[-1]
+        topic = last.get('topic', {})
+        group = self.convore.get_group(last.get('group')) or {}
+        users = []
+        for message in messages:
+            username = message.get('user', {}).get('username', '(anonymous)')
+            if username not in users:
+                users.append(username)
+        title = '{n} new messages in {group}'.format(
+            n=len(messages),
+            group=group.get('slug', '(unkonwn)'))
+        body = ('{name}: {users} '
+                '<a href="{base}{url}">#</a>').format(
+                name=topic.get('name', '(unknown)'),
+                base=config['BASE_URL'],
+                users=', '.join('@' + u for u in users),
+                url=topic.get('url', '/'))
+        self._notify_send(title, body, self.imgpath(last.get('user', {})))
+
+
+    def _notify_send(self, title, body, img):
+        timeout = 15000
         cmd = [config['NOTIFY_SEND'], '-t', str(timeout), title, body]
         if img:
             cmd.extend(['-i', img])
@@ -83,21 +231,13 @@ class Notifier(object):
         except KeyError:
             return None
 
-        filename = '{hash}.jpg'.format(hash=sha1(img).hexdigest())
-        path = os.path.join(self._tmpdir, filename)
+        return self._avatars.get(img)
 
-        if not os.path.exists(path):
-            debug('GET {url} HTTP/1.1'.format(url=img))
-            with closing(urlopen(img)) as src:
-                blocks = iter(lambda: src.read(4096), b'')
-                with closing(open(path, 'wb')) as dst:
-                    for block in blocks:
-                        dst.write(block)
-            img = self.Image.open(path)
-            img.thumbnail((64, 64), self.Image.ANTIALIAS)
-            img.save(path)
 
-        return path
+    def _thumbnail(self, path):
+        img = self.Image.open(path)
+        img.thumbnail((64, 64), self.Image.ANTIALIAS)
+        img.save(path)
 
 
     @property
@@ -107,12 +247,20 @@ class Notifier(object):
                 from PIL import Image
                 self._Image = Image
             except ImportError:
-                error('Python Imaging Library is not installed, '
-                      'no avatars will be shown')
+                log.error('Python Imaging Library is not installed, '
+                          'no avatars will be shown')
                 self._Image = None
         return self._Image
 
 
     def close(self):
-        rmtree(self._tmpdir)
+        self._closed = True
+        if self._thread.is_alive():
+            try:
+                self._queue.put_nowait(None)
+            except Full:
+                pass
+            self._thread.join(1.0)
+        if self._avatars:
+            self._avatars.close()
 
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import json
+import time
+import fcntl
+from glob import glob
+from itertools import count
+from threading import Thread, Condition
+
+from convoread.config import config
+from convoread.utils import (Logger, Backoff, data_dir, atomic_write,
+                             makedirs)
+
+
+log = Logger('outbox')
+
+
+class Outbox(object):
+    '''Messages waiting to be sent, persisted in the user data dir.
+
+    Messages are sent by a background thread by calling `send(topic_id,
+    text)`, in the order they were posted within each topic. If it raises an
+    exception `e` and `is_retryable(e)` is true, the message is sent again
+    after a backoff delay, otherwise it is dropped. A topic waiting for a
+    retry doesn't hold up other topics.
+
+    Each process keeps its messages in its own file and holds an exclusive
+    lock on it while running. Files of processes that have exited are
+    adopted at startup, so consoles running at once never send each other's
+    messages or overwrite them.
+    '''
+    def __init__(self, send, is_retryable, directory=None):
+        if directory is None:
+            directory = os.path.join(data_dir(), 'outbox')
+        self.directory = makedirs(directory)
+        name = 'outbox-{0}'.format(os.getpid())
+        self.path = os.path.join(self.directory, name + '.json')
+        self._send = send
+        self._is_retryable = is_retryable
+        self._ids = count()
+        with _Lock(os.path.join(self.directory, 'adopt.lock')):
+            self._lock = _Lock(os.path.join(self.directory, name + '.lock'))
+            self._entries = self._adopt()
+        self._retries = {}
+        self._cond = Condition()
+        self._closed = False
+        self.sent = 0
+        self.dropped = 0
+        self._thread = Thread(target=self._run, name='outbox')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def put(self, topic_id, text):
+        id = '{0}-{1}-{2}'.format(os.getpid(), int(time.time() * 1000),
+                                  next(self._ids))
+        with self._cond:
+            self._entries.append({'id': id, 'topic': topic_id,
+                                  'message': text})
+            self._save()
+            self._cond.notify()
+
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._entries),
+                'retrying': len(self._retries),
+                'sent': self.sent,
+                'dropped': self.dropped,
+            }
+
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(1.0)
+        with self._cond:
+            if not self._entries:
+                _remove_file(self.path)
+        self._lock.release(remove=True)
+
+
+    def _run(self):
+        while True:
+            with self._cond:
+                entry, timeout = self._next()
+                while entry is None and not self._closed:
+                    self._cond.wait(timeout)
+                    entry, timeout = self._next()
+                if self._closed:
+                    return
+            try:
+                self._send(entry['topic'], entry['message'])
+            except Exception, e:
+                self._failed(entry, e)
+            else:
+                self._done(entry)
+
+
+    def _next(self):
+        '''Return the next entry to send and the time to wait if there's none.
+
+        Called with the lock held.
+        '''
+        now = time.time()
+        timeout = None
+        seen = set()
+        for entry in self._entries:
+            topic_id = entry['topic']
+            if topic_id in seen:
+                continue
+            seen.add(topic_id)
+            retry = self._retries.get(topic_id)
+            if retry is None or retry[1] <= now:
+                return entry, None
+            if timeout is None or retry[1] - now < timeout:
+                timeout = retry[1] - now
+        return None, timeout
+
+
+    def _done(self, entry):
+        with self._cond:
+            self._remove(entry)
+            self._retries.pop(entry['topic'], None)
+            self.sent += 1
+
+
+    def _failed(self, entry, e):
+        topic_id = entry['topic']
+        if not self._is_retryable(e):
+            log.error('cannot send message to topic {0}: {1}', topic_id,
+                      unicode(e))
+            with self._cond:
+                self._remove(entry)
+                self.dropped += 1
+            return
+        with self._cond:
+            backoff = self._retries.get(topic_id, (None, 0))[0]
+            if backoff is None:
+                backoff = Backoff(config['LIVE_BACKOFF_BASE'],
+                                  config['LIVE_BACKOFF_MAX'])
+            delay = backoff.next()
+            self._retries[topic_id] = (backoff, time.time() + delay)
+        # Report only the first failure of a topic
+        report = log.warning if backoff.attempts == 1 else log.debug
+        report('cannot send message to topic {0}: {1}, retrying in '
+               '{2:.1f} secs...', topic_id, unicode(e), delay)
+
+
+    def _remove(self, entry):
+        self._entries = [e for e in self._entries if e is not entry]
+        self._save()
+
+
+    def _adopt(self):
+        '''Return the entries of this process and of exited processes.
+
+        Called with the adoption lock held. A file left by a process with
+        the same pid is ours, other files are adopted only if nobody holds
+        their locks. Adopted files are removed once the entries are saved
+        here, and entries seen before aren't added again.
+        '''
+        entries = _load(self.path)
+        ids = set(e.get('id') for e in entries)
+        adopted = []
+        # The outbox used to be shared by all processes
+        paths = [os.path.join(os.path.dirname(self.directory),
+                              'outbox.json')]
+        paths.extend(glob(os.path.join(self.directory, 'outbox-*.json')))
+        for path in paths:
+            if path == self.path or not os.path.exists(path):
+                continue
+            lock = None
+            if path.startswith(self.directory):
+                lock = _Lock(os.path.splitext(path)[0] + '.lock',
+                             blocking=False)
+                if not lock.locked:
+                    continue
+            for entry in _load(path):
+                id = entry.get('id')
+                if id is None or id not in ids:
+                    ids.add(id)
+                    entries.append(entry)
+            adopted.append((path, lock))
+        if adopted:
+            log.debug('adopted outbox files {0}', [p for p, _ in adopted])
+            self._entries = entries
+            self._save()
+        for path, lock in adopted:
+            _remove_file(path)
+            if lock:
+                lock.release(remove=True)
+        return entries
+
+
+    def _save(self):
+        try:
+            atomic_write(self.path, json.dumps(self._entries).encode('UTF-8'))
+        except (IOError, OSError), e:
+            log.error('cannot save outbox "{0}": {1}', self.path, e)
+
+
+class _Lock(object):
+    '''An exclusive `flock` on a lock file, held until `release`.'''
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._fd, flags)
+            self.locked = True
+        except IOError:
+            os.close(self._fd)
+            self._fd = None
+            self.locked = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+    def release(self, remove=False):
+        if self._fd is None:
+            return
+        if remove:
+            _remove_file(self.path)
+        os.close(self._fd)
+        self._fd = None
+        self.locked = False
+
+
+def _load(path):
+    try:
+        with open(path, 'rb') as fd:
+            return json.loads(fd.read().decode('UTF-8'))
+    except IOError:
+        return []
+    except ValueError, e:
+        log.error('ignoring corrupted outbox "{0}": {1}', path, e)
+        return []
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
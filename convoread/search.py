@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import re
+import math
+from threading import Thread, Lock
+from Queue import Queue, Full
+
+from convoread.config import config
+from convoread.models import Message, Topic, User
+from convoread.utils import Logger, data_dir, startup_trace
+
+
+log = Logger('search')
+
+# Imported by the indexing thread, see `SearchIndex._run`
+sqlite3 = None
+
+_WORD = re.compile(r'\w\w+', re.UNICODE)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    topic INTEGER,
+    grp INTEGER,
+    username TEXT,
+    created REAL,
+    message TEXT
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT,
+    message INTEGER,
+    count INTEGER,
+    grp INTEGER,
+    PRIMARY KEY (term, message)
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    df INTEGER
+);
+'''
+
+
+def tokenize(text):
+    '''Return a dict of counts of the words in `text`.'''
+    counts = {}
+    for word in _WORD.findall(text.lower()):
+        counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+class SearchIndex(object):
+    '''Full-text index of messages in an SQLite database.
+
+    The index is a table of postings: the number of occurrences of each word
+    in each message. Messages are indexed by a background thread, adding them
+    only puts them into a queue.
+
+    Search results contain all the words of the query. A query reads the
+    postings of its rarest word from the most recent message backwards,
+    looks up the other words in the same messages and stops after
+    `SEARCH_CANDIDATES` matches, so its cost doesn't depend on the size of
+    the index. The matches are ranked by TF-IDF, then by recency.
+    '''
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(data_dir(), 'search.db')
+        self.path = path
+        self.enabled = True
+        self._queue = Queue(config['SEARCH_QUEUE_SIZE'])
+        # The database is opened by the indexing thread, searches find
+        # nothing until then
+        self._db = None
+        self._total = 0
+        self._lock = Lock()
+        self.dropped = 0
+        self._thread = Thread(target=self._run, name='search')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def add(self, topic_id, group_id, messages):
+        '''Queue messages of a topic for indexing.'''
+        if not self.enabled or not messages:
+            return
+        try:
+            self._queue.put_nowait((topic_id, group_id, messages))
+        except Full:
+            self.dropped += len(messages)
+
+
+    def search(self, query, group_id=None, limit=20):
+        '''Return messages matching all words of `query`, best first.'''
+        terms = list(tokenize(query))
+        if not self.enabled or not terms:
+            return []
+        with self._lock:
+            if self._db is None:
+                return []
+            weights = {}
+            for term in terms:
+                row = self._db.execute('SELECT df FROM terms WHERE term = ?',
+                                       (term,)).fetchone()
+                if not row:
+                    return []
+                weights[term] = (row[0], math.log(1.0 + float(self._total) /
+                                                  row[0]))
+            terms.sort(key=lambda term: weights[term][0])
+            sql, args = _search_query(terms, group_id,
+                                      config['SEARCH_CANDIDATES'])
+            matches = self._db.execute(sql, args).fetchall()
+            scores = [(sum(count * weights[term][1]
+                           for term, count in zip(terms, counts)), id)
+                      for id, counts in _split_counts(matches)]
+            scores.sort(reverse=True)
+            ids = [id for _, id in scores[:limit]]
+            rows = self._db.execute(
+                    'SELECT id, topic, grp, username, created, message '
+                    'FROM messages WHERE id IN ({0})'.format(
+                            ', '.join(['?'] * len(ids))), ids).fetchall()
+        order = dict((id, i) for i, id in enumerate(ids))
+        rows.sort(key=lambda row: order[row[0]])
+        return [_message(row) for row in rows]
+
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        return {
+            'messages': self._total,
+            'queued': self._queue.qsize(),
+            'dropped': self.dropped,
+        }
+
+
+    def close(self):
+        if not self.enabled:
+            return
+        self._queue.put(None)
+        self._thread.join(1.0)
+
+
+    def _open(self):
+        db = self._connect()
+        db.executescript(SCHEMA)
+        total = db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        with self._lock:
+            self._db = db
+            self._total = total
+        startup_trace.mark('search index')
+
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        # Readers don't wait for the indexing thread in the WAL mode
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+
+    def _run(self):
+        # Imported here so that loading it doesn't delay the startup
+        global sqlite3
+        try:
+            import sqlite3
+        except ImportError:
+            log.error('sqlite3 module is not available, search is disabled')
+            self.enabled = False
+            return
+        try:
+            self._open()
+        except sqlite3.Error, e:
+            log.error('cannot open search index "{0}": {1}', self.path, e)
+            self.enabled = False
+            return
+        db = self._connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            items = [item]
+            # Index everything queued in one transaction
+            while not self._queue.empty():
+                item = self._queue.get()
+                if item is None:
+                    break
+                items.append(item)
+            try:
+                with db:
+                    added = sum(self._index(db, topic_id, group_id, messages)
+                                for topic_id, group_id, messages in items)
+            except sqlite3.Error, e:
+                log.error('cannot index messages: {0}', e)
+            else:
+                with self._lock:
+                    self._total += added
+            if item is None:
+                break
+        db.close()
+
+
+    def _index(self, db, topic_id, group_id, messages):
+        added = 0
+        for message in messages:
+            id = message.get('id')
+            text = message.get('message') or ''
+            cursor = db.execute(
+                    'INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)',
+                    (id, topic_id, group_id,
+                     message.get('user', {}).get('username'),
+                     message.get('date_created', message.get('_ts')), text))
+            if not cursor.rowcount:
+                continue
+            added += 1
+            terms = tokenize(text)
+            db.executemany('INSERT INTO postings VALUES (?, ?, ?, ?)',
+                           [(term, id, count, group_id)
+                            for term, count in terms.items()])
+            db.executemany('INSERT OR IGNORE INTO terms VALUES (?, 0)',
+                           [(term,) for term in terms])
+            db.executemany('UPDATE terms SET df = df + 1 WHERE term = ?',
+                           [(term,) for term in terms])
+        return added
+
+
+def _search_query(terms, group_id, limit):
+    '''Return SQL and arguments for the recent messages with all `terms`.
+
+    Each result row is the message id and the counts of the terms.
+    '''
+    columns = ['p0.message'] + ['p{0}.count'.format(i)
+                                for i in range(len(terms))]
+    joins = ['JOIN postings AS p{0} ON p{0}.term = ? AND '
+             'p{0}.message = p0.message'.format(i)
+             for i in range(1, len(terms))]
+    where = 'p0.term = ?'
+    args = list(terms[1:]) + [terms[0]]
+    if group_id is not None:
+        where += ' AND p0.grp = ?'
+        args.append(group_id)
+    args.append(limit)
+    sql = '''
+        SELECT {columns} FROM postings AS p0 {joins}
+        WHERE {where} ORDER BY p0.message DESC LIMIT ?
+    '''.format(columns=', '.join(columns), joins=' '.join(joins), where=where)
+    return sql, args
+
+
+def _split_counts(rows):
+    return [(row[0], row[1:]) for row in rows]
+
+
+def _message(row):
+    id, topic_id, group_id, username, created, text = row
+    return Message(id=id, topic=Topic(id=topic_id), group=group_id,
+                   user=User(username=username), date_created=created,
+                   message=text)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import json
+import errno
+import time
+from threading import Event, Lock
+
+from convoread.config import config
+from convoread.utils import Logger, atomic_write
+
+
+log = Logger('stream')
+
+BUFFER_SIZE = 64 * 1024
+
+
+class Streamer(object):
+    '''Writes live events to a file as JSON Lines.
+
+    Events are written as sent by the server, one per line, optionally only
+    those of a group with the slug `group` or of the topic `topic`. Each poll
+    is written with a single flush of a buffered file. If `cursor_file` is
+    given, the id of the last written event is saved there at most every
+    `STREAM_CURSOR_INTERVAL` seconds and on `close`, and the stream resumes
+    after it next time.
+    '''
+    def __init__(self, convore, fd=None, group=None, topic=None,
+                 cursor_file=None):
+        if fd is None:
+            fd = os.fdopen(sys.stdout.fileno(), 'wb', BUFFER_SIZE)
+        self.convore = convore
+        self._fd = fd
+        self._group = group
+        self._group_id = None
+        self._topic = topic
+        self._cursor_file = cursor_file
+        self._cursor = None
+        self._cursor_saved = 0
+        self._cursor_lock = Lock()
+        self._closed = Event()
+        self.written = 0
+
+
+    def run(self):
+        '''Write events until `close` is called or the output is closed.'''
+        if self._group:
+            group = self.convore.get_group_by_slug(self._group)
+            if not group:
+                raise ValueError('group "{0}" not found'.format(self._group))
+            self._group_id = group.get('id')
+        cursor = self._load_cursor()
+        if cursor:
+            self.convore.set_live_cursor(cursor)
+        self.convore.on_live_batch(self.handle_live_batch, raw=True)
+        self.convore.set_ready()
+        # Waiting with a timeout lets KeyboardInterrupt through
+        while not self._closed.is_set():
+            self._closed.wait(1.0)
+            self._save_cursor()
+
+
+    def close(self):
+        self._closed.set()
+        self._save_cursor(force=True)
+
+
+    def handle_live_batch(self, events):
+        if self._closed.is_set() or not events:
+            return
+        lines = [json.dumps(event, separators=(b',', b':')) + b'\n'
+                 for event in events if self._match(event)]
+        try:
+            self._fd.write(b''.join(lines))
+            self._fd.flush()
+        except IOError, e:
+            if e.errno == errno.EPIPE:
+                log.debug('output closed')
+            else:
+                log.error('cannot write events: {0}', e)
+            self.close()
+            return
+        self.written += len(lines)
+        cursor = events[-1].get('_id')
+        if self._cursor_file and cursor is not None:
+            with self._cursor_lock:
+                self._cursor = cursor
+            self._save_cursor()
+
+
+    def _match(self, event):
+        if self._group_id is not None and event.get('group') != self._group_id:
+            return False
+        topic = event.get('topic') or {}
+        if self._topic is not None and topic.get('id') != self._topic:
+            return False
+        return True
+
+
+    def _load_cursor(self):
+        if not self._cursor_file:
+            return None
+        try:
+            with open(self._cursor_file, 'rb') as fd:
+                return fd.read().decode('UTF-8').strip() or None
+        except IOError:
+            return None
+
+
+    def _save_cursor(self, force=False):
+        with self._cursor_lock:
+            cursor = self._cursor
+            if cursor is None:
+                return
+            # Saving means an fsync, which is not worth doing for every poll
+            if (not force and time.time() - self._cursor_saved <
+                    config['STREAM_CURSOR_INTERVAL']):
+                return
+            self._cursor = None
+            self._cursor_saved = time.time()
+            try:
+                atomic_write(self._cursor_file,
+                             unicode(cursor).encode('UTF-8'))
+            except (IOError, OSError), e:
+                log.error('cannot save cursor "{0}": {1}',
+                          self._cursor_file, e)
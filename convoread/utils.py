@@ -27,79 +27,319 @@ import sys
 import os
 import traceback
 import textwrap
+import errno
+import logging
+import random
+import time
+from tempfile import NamedTemporaryFile
 from netrc import netrc
-from threading import RLock, current_thread
+from urlparse import urlparse
+from threading import Lock, RLock, Timer, current_thread
 from functools import wraps
 
 from convoread.config import config
+from convoread.metrics import metrics
 
-try:
-    import readline
-except ImportError:
-    print('readline module not available', file=sys.stderr)
-    readline = None
+# Imported by `init_readline` for interactive consoles only
+readline = None
 
 
 stdout = os.fdopen(sys.stdout.fileno(), 'wb', 0)
 stderr = os.fdopen(sys.stderr.fileno(), 'wb', 0)
 
 
-def debug(msg):
-    if not config['DEBUG']:
-        return
-    thread = current_thread()
-    async = thread.name != 'MainThread'
-    _print('debug: {0}'.format(msg), stderr, async)
+class Logger(object):
+    '''A leveled logger of a convoread subsystem.
 
+    Messages are `format` templates that are formatted only if the level is
+    enabled, use `lazy` for arguments that are expensive to compute. Keyword
+    arguments are appended to the message as `key=value` fields.
+    '''
+    def __init__(self, subsystem=None):
+        name = 'convoread'
+        if subsystem:
+            name += '.' + subsystem
+        self._logger = logging.getLogger(name)
 
-def error(msg, exc=False):
-    thread = current_thread()
-    async = thread.name != 'MainThread'
-    _print('error: {0}'.format(msg), stderr, async)
-    if exc:
-        _print('\n{0}'.format(traceback.format_exc()), stderr, async)
+
+    def enabled(self, level=logging.DEBUG):
+        return self._logger.isEnabledFor(level)
+
+
+    def log(self, level, msg, *args, **fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        exc = fields.pop('exc', False)
+        if args:
+            msg = msg.format(*args)
+        if fields:
+            msg += ''.join(' {0}={1}'.format(k, fields[k])
+                           for k in sorted(fields))
+        self._logger.log(level, msg, exc_info=bool(exc))
+
+
+    def debug(self, msg, *args, **fields):
+        self.log(logging.DEBUG, msg, *args, **fields)
+
+
+    def info(self, msg, *args, **fields):
+        self.log(logging.INFO, msg, *args, **fields)
+
+
+    def warning(self, msg, *args, **fields):
+        self.log(logging.WARNING, msg, *args, **fields)
+
+
+    def error(self, msg, *args, **fields):
+        self.log(logging.ERROR, msg, *args, **fields)
+
+
+class lazy(object):
+    '''A call deferred until its result is formatted into a log message.'''
+    def __init__(self, f, *args, **kwargs):
+        self._f = f
+        self._args = args
+        self._kwargs = kwargs
+
+
+    def __format__(self, spec):
+        return format(self._f(*self._args, **self._kwargs), spec)
+
+
+class _ConsoleHandler(logging.Handler):
+    def emit(self, record):
+        thread = current_thread()
+        async = thread.name != 'MainThread'
+        msg = record.getMessage()
+        subsystem = record.name.partition('.')[2]
+        if subsystem:
+            msg = '{0}: {1}'.format(subsystem, msg)
+        _print('{0}: {1}'.format(record.levelname.lower(), msg), stderr,
+               async)
+        if record.exc_info:
+            _print('\n{0}'.format(
+                       ''.join(traceback.format_exception(*record.exc_info))),
+                   stderr, async)
+
+
+def setup_logging():
+    '''Set the log level of all subsystems according to the config.'''
+    level = logging.DEBUG if config['DEBUG'] else logging.INFO
+    logging.getLogger('convoread').setLevel(level)
+
+
+_root = logging.getLogger('convoread')
+_root.addHandler(_ConsoleHandler())
+_root.propagate = False
+setup_logging()
+_log = Logger()
+
+
+def debug(msg, *args, **fields):
+    _log.debug(msg, *args, **fields)
+
+
+def error(msg, *args, **fields):
+    _log.error(msg, *args, **fields)
 
 
 def output(msg, fd=stdout, async=False):
     _print(msg, fd, async)
 
 
+def flush_output():
+    '''Write async output that is waiting for the next redraw.'''
+    for compositor in list(_compositors.values()):
+        compositor.flush()
+
+
 def _print(msg, fd, async):
-    data = msg.encode(config['ENCODING'], 'replace')
-    if async and fd.isatty() and readline:
-        prompt = config['PROMPT']
+    data = msg.encode(config['ENCODING'], 'replace') + b'\n'
+    try:
+        compositor = _compositors[fd]
+    except KeyError:
+        compositor = _compositors.setdefault(fd, _Compositor(fd))
+    if async:
+        compositor.write_async(data)
+    else:
+        compositor.write(data)
+
+
+class _Compositor(object):
+    '''Output to a file that may be a terminal with an input prompt.
+
+    Async lines printed while the user is typing are queued. A redraw clears
+    the prompt line, writes all the queued lines and restores the prompt
+    with the input buffer in a single write. There are at most `OUTPUT_FPS`
+    redraws per second. Output to other files is written as is.
+    '''
+    def __init__(self, fd):
+        self._fd = fd
+        self._tty = fd.isatty()
+        self._pending = []
+        self._scheduled = False
+        self._last = 0
+        self._lock = Lock()
+
+
+    def write(self, data):
+        with self._lock:
+            if self._pending:
+                self._redraw(data)
+            else:
+                self._fd.write(data)
+
+
+    def write_async(self, data):
+        if not (readline and self._tty):
+            with self._lock:
+                self._fd.write(data)
+            return
+        with self._lock:
+            self._pending.append(data)
+            if self._scheduled:
+                return
+            delay = self._last + 1.0 / config['OUTPUT_FPS'] - time.time()
+            if delay <= 0:
+                self._redraw()
+                return
+            self._scheduled = True
+        timer = Timer(delay, self.flush)
+        timer.daemon = True
+        timer.start()
+
+
+    def flush(self):
+        with self._lock:
+            self._scheduled = False
+            if self._pending:
+                self._redraw()
+
+
+    def _redraw(self, data=None):
+        # Called with the lock held
+        lines = self._pending
+        self._pending = []
+        if data is not None:
+            # Synchronous output goes after the queued lines, the prompt is
+            # redrawn by readline
+            self._fd.write(b''.join(lines) + data)
+            return
+        prompt = config['PROMPT'].encode(config['ENCODING'], 'replace')
         buf = readline.get_line_buffer()
         clear = b'\r' + b' ' * (len(buf) + len(prompt)) + b'\r'
-        fd.write(clear)
-        fd.write(data)
-        fd.write(b'\n')
-        fd.write(prompt)
-        fd.write(buf)
-        fd.flush()
-    else:
-        fd.write(data)
-        fd.write(b'\n')
-        fd.flush()
+        self._fd.write(b''.join([clear] + lines + [prompt, buf]))
+        self._last = time.time()
+
+
+_compositors = {}
+
+
+def init_readline():
+    '''Enable line editing of `raw_input`, return False if not available.'''
+    global readline
+    if readline is None:
+        try:
+            import readline as module
+        except ImportError:
+            print('readline module not available', file=sys.stderr)
+            module = False
+        readline = module
+    return bool(readline)
+
+
+def base_url():
+    '''Return `(secure, host, port)` of the API base URL from the config.'''
+    url = urlparse(config['BASE_URL'])
+    secure = url.scheme == 'https'
+    return secure, url.hostname, url.port or (443 if secure else 80)
 
 
 def get_passwd():
     try:
-        rc = netrc(os.path.expanduser('~/.netrc'))
+        rc = netrc(os.path.expanduser(config['NETRC']))
     except IOError:
         print("Please create .netrc in your home dir,"
               " can't work without credentials")
         sys.exit(1)
     login = password = None
-    res = rc.authenticators('convore.com')
+    res = rc.authenticators(base_url()[1])
     if res:
         login, password = res[0].strip(), res[2].strip()
     return login, password
 
 
+def data_dir():
+    '''Return the directory for persistent user data, creating it if needed.'''
+    return _user_dir('XDG_DATA_HOME', '~/.local/share')
+
+
+def cache_dir():
+    '''Return the directory for cached files, creating it if needed.'''
+    return _user_dir('XDG_CACHE_HOME', '~/.cache')
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def _user_dir(env, default):
+    base = os.environ.get(env, os.path.expanduser(default))
+    return makedirs(os.path.join(base, 'convoread'))
+
+
+def atomic_write(path, data):
+    '''Replace the contents of the file at `path` with `data` atomically.
+
+    The data is written to a temporary file in the same directory first, so
+    a crash leaves either the old or the new contents in place.
+    '''
+    dirname = os.path.dirname(path)
+    f = NamedTemporaryFile(dir=dirname, prefix='.tmp', delete=False)
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(f.name, path)
+    except:
+        f.close()
+        os.remove(f.name)
+        raise
+
+
 def wrap_string(s, indent=4, width=75):
     return '\n'.join((' ' * indent) + line for line in textwrap.wrap(s, width))
 
 
+class Backoff(object):
+    '''Exponential backoff with full jitter.
+
+    The delay before the n-th retry is a random value between 0 and
+    `min(cap, base * 2 ** n)`, so that many clients retrying at once spread
+    over time.
+    '''
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+
+    def next(self):
+        limit = min(self.cap, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(0, limit)
+
+
+    def reset(self):
+        self.attempts = 0
+
+
 def synchronized(f):
     @wraps(f)
     def wrapper(self, *args, **kwargs):
@@ -107,7 +347,59 @@ def synchronized(f):
             lock = self._lock
         except AttributeError:
             lock = self._lock = RLock()
-        with lock:
+        # Waiting is timed only when the lock is contended
+        if not lock.acquire(False):
+            started = time.time()
+            lock.acquire()
+            metrics.observe('lock {0}.{1}'.format(type(self).__name__,
+                                                  f.__name__),
+                            time.time() - started)
+        try:
             return f(self, *args, **kwargs)
+        finally:
+            lock.release()
     return wrapper
 
+
+class StartupTrace(object):
+    '''Times of the startup phases, shown with `--startup-trace`.
+
+    Phases are marked when they end. The ones that end before the first
+    prompt are shown by `report`, the ones that end in background threads
+    later are shown as they happen.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._started = time.time()
+        self._last = self._started
+        self._phases = []
+        self._reported = False
+        self._lock = Lock()
+
+
+    def mark(self, name):
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.time()
+            line = '{0:8.1f} ms {1:+8.1f} ms  {2}'.format(
+                (now - self._started) * 1000, (now - self._last) * 1000, name)
+            self._last = now
+            if not self._reported:
+                self._phases.append(line)
+                return
+        output('startup: ' + line, async=True)
+
+
+    def report(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            lines, self._phases = self._phases, []
+            self._reported = True
+        output('startup:    total     phase')
+        for line in lines:
+            output('startup: ' + line)
+
+
+startup_trace = StartupTrace()
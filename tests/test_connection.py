@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import unicode_literals, print_function
+from __future__ import unicode_literals, print_function
+
+import os
+import socket
+import ssl
+import time
+import unittest
+from httplib import HTTPConnection, HTTPSConnection
+from threading import Event, Thread
+
+from convoread.convore import Connection
+
+
+CERT_FILE = os.path.join(os.path.dirname(__file__), 'keycert.pem')
+
+
+class IdleServer(object):
+    '''Accepts one connection and keeps it idle until `close_client`.'''
+    def __init__(self, secure):
+        self._secure = secure
+        self._sock = socket.socket()
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(1)
+        self.port = self._sock.getsockname()[1]
+        self._close = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _run(self):
+        client, _ = self._sock.accept()
+        if self._secure:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.load_cert_chain(CERT_FILE)
+            client = context.wrap_socket(client, server_side=True)
+        self._close.wait()
+        client.close()
+
+
+    def close_client(self):
+        self._close.set()
+        self._thread.join()
+
+
+    def stop(self):
+        self.close_client()
+        self._sock.close()
+
+
+def connect(server, secure):
+    connection = Connection.__new__(Connection)
+    if secure:
+        context = ssl.create_default_context(cafile=CERT_FILE)
+        connection.http = HTTPSConnection('localhost', server.port,
+                                          context=context)
+    else:
+        connection.http = HTTPConnection('127.0.0.1', server.port)
+    connection.http.connect()
+    return connection
+
+
+class IsAliveTest(unittest.TestCase):
+    def check(self, secure):
+        server = IdleServer(secure)
+        self.addCleanup(server.stop)
+        connection = connect(server, secure)
+        self.addCleanup(connection.close)
+        # Give a TLS 1.3 server time to send its session tickets
+        time.sleep(0.2)
+        for _ in range(3):
+            self.assertTrue(connection.is_alive())
+        server.close_client()
+        time.sleep(0.2)
+        self.assertFalse(connection.is_alive())
+
+
+    def test_plain(self):
+        self.check(False)
+
+
+    def test_tls(self):
+        self.check(True)
+
+
+    def test_never_connected(self):
+        connection = Connection.__new__(Connection)
+        connection.http = HTTPConnection('127.0.0.1', 1)
+        self.assertFalse(connection.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import unicode_literals, print_function
+
+import json
+import random
+import unittest
+
+from convoread.jsonstream import ItemDecoder, iter_batches
+
+
+def random_value(rnd, depth=0):
+    kinds = ['int', 'float', 'exp', 'string', 'literal']
+    if depth < 3:
+        kinds += ['list', 'dict']
+    kind = rnd.choice(kinds)
+    if kind == 'int':
+        return rnd.randint(-10 ** 6, 10 ** 6)
+    if kind == 'float':
+        return round(rnd.uniform(-1000, 1000), rnd.randint(1, 6))
+    if kind == 'exp':
+        return rnd.choice([1.5e-7, -2e21, 3.25e+30])
+    if kind == 'string':
+        return ''.join(rnd.choice('ab "\\/]},:é中\n')
+                       for _ in range(rnd.randint(0, 12)))
+    if kind == 'literal':
+        return rnd.choice([True, False, None])
+    if kind == 'list':
+        return [random_value(rnd, depth + 1)
+                for _ in range(rnd.randint(0, 4))]
+    return dict(('k{0}'.format(i), random_value(rnd, depth + 1))
+                for i in range(rnd.randint(0, 4)))
+
+
+def random_chunks(rnd, data):
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rnd.choice([1, 2, 3, rnd.randint(1, 64)])
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+class ItemDecoderTest(unittest.TestCase):
+    def test_random_chunks(self):
+        rnd = random.Random(1)
+        for _ in range(3000):
+            doc = dict(('f{0}'.format(i), random_value(rnd))
+                       for i in range(rnd.randint(0, 3)))
+            doc['messages'] = [random_value(rnd)
+                               for _ in range(rnd.randint(0, 8))]
+            data = json.dumps(doc, ensure_ascii=rnd.random() < 0.5,
+                              indent=rnd.choice([None, 1]))
+            if isinstance(data, unicode):
+                data = data.encode('UTF-8')
+            decoder = ItemDecoder('messages')
+            items = []
+            for chunk in random_chunks(rnd, data):
+                items.extend(decoder.feed(chunk))
+            items.extend(decoder.close())
+            self.assertEqual(items, doc['messages'])
+            del doc['messages']
+            self.assertEqual(decoder.fields, doc)
+
+
+    def test_split_number(self):
+        batches = iter_batches([b'{"messages": [1.', b'5, 2', b'e3]}'],
+                               'messages')
+        self.assertEqual([i for b in batches for i in b], [1.5, 2000.0])
+
+
+    def test_bad_documents(self):
+        for data in [b'{"messages": [1, 2', b'{"messages": [1 2]}', b'[1]',
+                     b'{"a": 1} x', b'']:
+            self.assertRaises(ValueError, list,
+                              iter_batches([data[:3], data[3:]], 'messages'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2011 The Convoread Authors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import unicode_literals, print_function
+from __future__ import unicode_literals, print_function
+
+import unittest
+
+from convoread.messages import MessageStore
+
+
+def message(id):
+    return {'id': id, 'date_created': float(id)}
+
+
+class MessageStoreTest(unittest.TestCase):
+    def test_live_message_during_first_fetch(self):
+        store = MessageStore(10)
+        store.start_fetch(1)
+        # The live message arrives after the server has sent the response
+        store.add(1, message(3))
+        merged = store.merge(1, [message(1), message(2)])
+        self.assertEqual([m['id'] for m in merged], [1, 2, 3])
+        self.assertEqual([m['id'] for m in store.get(1)], [1, 2, 3])
+        self.assertEqual(store.stats()['messages'], 3)
+
+
+    def test_live_message_also_fetched(self):
+        store = MessageStore(10)
+        store.start_fetch(1)
+        store.add(1, message(2))
+        merged = store.merge(1, [message(1), message(2)])
+        self.assertEqual([m['id'] for m in merged], [1, 2])
+
+
+    def test_cancelled_fetch(self):
+        store = MessageStore(10)
+        store.start_fetch(1)
+        store.cancel_fetch(1)
+        store.add(1, message(3))
+        merged = store.merge(1, [message(1)])
+        self.assertEqual([m['id'] for m in merged], [1])
+
+
+    def test_topic_not_fetched(self):
+        store = MessageStore(10)
+        store.add(1, message(1))
+        self.assertEqual(store.get(1), None)
+        self.assertEqual(store.stats()['topics'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()